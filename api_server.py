@@ -1,24 +1,26 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
-import uuid
+from typing import List, Literal, Optional
 import os
 import json
+import shutil
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Import core modules
-from core.embeddings import get_document_embedding, get_query_embedding
-from core.document_utils import (
-    pdf_to_images,
-    extract_text_from_pdf,
-    save_image_preview,
-    load_embeddings_and_info,
-    save_embeddings_and_info,
-)
-from core.search import search_documents, answer_with_gemini
-from PIL import Image
+from core.embeddings import get_document_embeddings, get_query_embedding, get_query_embeddings, embedding_cache, query_cache
+from core.document_utils import IndexStore
+from core.index_factory import recall_report
+from core.jobs import JobQueue
+from core.context import select_context, context_key, assemble_context
+from core.previews import PREVIEW_DIR, image_cache
+from core.metrics import registry, Gauge, cache_gauges, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from core.tracing import Trace, current_trace, traced, span, maybe_profile, profiling_settings, set_profiling
+from core.search import SEARCH_MODE, SEARCH_DIVERSIFY, search_documents, search_documents_batch, answer_with_gemini, stream_answer_with_gemini, answer_cache, answer_cache_key
 
 app = FastAPI(title="Multimodal RAG API", version="1.0.0")
 
@@ -31,26 +33,145 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Blocking work runs on these pools so the event loop keeps serving other
+# requests: query embedding + FAISS search, Gemini calls (slow, so sized for
+# many in flight) and index writes (serialised by IndexStore anyway)
+API_SEARCH_WORKERS = int(os.getenv('API_SEARCH_WORKERS', 16))
+API_LLM_WORKERS = int(os.getenv('API_LLM_WORKERS', 64))
+search_executor = ThreadPoolExecutor(max_workers=API_SEARCH_WORKERS, thread_name_prefix="search")
+llm_executor = ThreadPoolExecutor(max_workers=API_LLM_WORKERS, thread_name_prefix="llm")
+index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index")
+# Batch queries: most questions per request, and answers one batch generates
+# at once (so a large batch leaves LLM workers for interactive queries)
+API_BATCH_MAX_QUERIES = int(os.getenv('API_BATCH_MAX_QUERIES', 1000))
+API_BATCH_ANSWER_CONCURRENCY = int(os.getenv('API_BATCH_ANSWER_CONCURRENCY', 16))
+# /debug/profiling changes the profiler of every worker and the API has no
+# authentication, so it answers 404 unless enabled
+DEBUG_API_ENABLED = os.getenv('DEBUG_API_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+async def run_blocking(executor, fn, *args, **kwargs):
+    """Run a blocking call on ``executor`` without stalling the event loop; its spans go to the request's trace"""
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(traced(fn), *args, **kwargs))
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """Trace every request: per-stage totals in a Server-Timing header, and a sampled flame-graph profile.
+
+    Streamed responses only report the stages done before the first byte;
+    their profile covers the whole stream.
+    """
+    trace = Trace(f"{request.method} {request.url.path}")
+    token = current_trace.set(trace)
+    profiler = maybe_profile(trace)
+    try:
+        response = await call_next(request)
+    except BaseException:
+        if profiler is not None:
+            profiler.stop()
+        raise
+    finally:
+        current_trace.reset(token)
+    response.headers["Server-Timing"] = trace.server_timing()
+    if profiler is not None:
+        response.headers["X-Profile"] = profiler.name
+        body = response.body_iterator
+
+        async def profiled_body():
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+
+        response.body_iterator = profiled_body()
+    return response
+
+def request_debug(request):
+    """``debug`` field of a response: the request's timings so far, when the request asked for them"""
+    trace = current_trace.get()
+    if not request.debug or trace is None:
+        return None
+    return {"timings": trace.timings()}
+
 # Global state for embeddings
-faiss_index = None
-docs_info = []
+index_store = IndexStore()
+# Background ingestion for uploads
+job_queue = JobQueue(index_store, get_document_embeddings)
+
+# Index and cache state for /metrics, read when it is scraped
+registry.register(Gauge("rag_index_vectors", "Vectors in the FAISS index, deleted ones included",
+                        lambda: index_store.index.ntotal if index_store.index is not None else 0))
+registry.register(Gauge("rag_index_tombstones", "Deleted vectors still in the index",
+                        lambda: len(index_store.tombstones)))
+registry.register(Gauge("rag_index_generation", "Index generation, bumped by every change",
+                        lambda: index_store.generation))
+registry.register(Gauge("rag_documents", "Indexed entries by content type",
+                        lambda: {(content_type,): n for content_type, n in index_store.docs_info.counts().items()},
+                        ("content_type",)))
+cache_gauges({"embedding": embedding_cache, "query": query_cache, "answer": answer_cache, "image": image_cache})
 
 # Initialize embeddings on startup
 @app.on_event("startup")
 async def startup_event():
-    global faiss_index, docs_info
-    faiss_index, docs_info = load_embeddings_and_info()
+    await run_blocking(index_executor, index_store.load)
+    # Pick up uploads and deletions made by other workers and the Streamlit app
+    index_store.watch()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    index_store.stop_watching()
+    await run_blocking(index_executor, job_queue.shutdown)
+    for executor in (search_executor, llm_executor, index_executor):
+        executor.shutdown(wait=False)
 
 # Pydantic models
 class QueryRequest(BaseModel):
     query: str
     top_k: Optional[int] = 3
+    # ANN search-time knobs; ignored by index types they do not apply to
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    # "hybrid" (vector + keyword), "vector" or "lexical" (keyword only, no
+    # embedding call); SEARCH_MODE when omitted
+    mode: Optional[Literal["hybrid", "vector", "lexical"]] = None
+    # Search only matching entries
+    content_type: Optional[Literal["text", "image"]] = None
+    source: Optional[str] = None
+    doc_id_prefix: Optional[str] = None
+    # Rerank for diversity and collapse near-duplicate pages; SEARCH_DIVERSIFY when omitted
+    diversify: Optional[bool] = None
+    # Return the request's trace spans in the response's ``debug`` field
+    debug: Optional[bool] = False
+
+class BatchQueryRequest(BaseModel):
+    queries: List[str]
+    top_k: Optional[int] = 3
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    mode: Optional[Literal["hybrid", "vector", "lexical"]] = None
+    content_type: Optional[Literal["text", "image"]] = None
+    source: Optional[str] = None
+    doc_id_prefix: Optional[str] = None
+    diversify: Optional[bool] = None
+    # False returns retrieval results only, e.g. for retrieval evaluations
+    generate_answers: Optional[bool] = True
 
 class QueryResponse(BaseModel):
     answer: str
     sources: List[dict]
     query: str
     timestamp: str
+    debug: Optional[dict] = None
+
+class ProfilingSettings(BaseModel):
+    # Fraction of requests and ingestion jobs to profile (0 turns profiling off)
+    sample_rate: Optional[float] = None
+    # Seconds between stack samples
+    interval: Optional[float] = None
+
+class BatchQueryResponse(BaseModel):
+    results: List[dict]
+    timestamp: str
 
 class DocumentInfo(BaseModel):
     doc_id: str
@@ -65,6 +186,11 @@ class SystemStatus(BaseModel):
     text_documents: int
     image_documents: int
     faiss_index_size: Optional[int] = None
+    index_type: Optional[str] = None
+    embedding_cache: Optional[dict] = None
+    query_cache: Optional[dict] = None
+    answer_cache: Optional[dict] = None
+    image_cache: Optional[dict] = None
 
 # API Endpoints
 
@@ -73,10 +199,9 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "multimodal-rag-api"}
 
-@app.get("/status", response_model=SystemStatus)
-async def get_system_status():
-    """Get system status and statistics"""
-    global faiss_index, docs_info
+def system_status():
+    # Blocking: counts entries and reads the cache statistics (a SQLite query for the disk answer cache)
+    faiss_index, docs_info = index_store.index, index_store.docs_info
     
     text_count = sum(1 for doc in docs_info if doc["content_type"] == "text")
     image_count = sum(1 for doc in docs_info if doc["content_type"] == "image")
@@ -86,157 +211,279 @@ async def get_system_status():
         total_documents=len(docs_info),
         text_documents=text_count,
         image_documents=image_count,
-        faiss_index_size=faiss_index.ntotal if faiss_index else 0
+        faiss_index_size=faiss_index.ntotal if faiss_index else 0,
+        index_type=index_store.index_type,
+        embedding_cache=embedding_cache.stats(),
+        query_cache=query_cache.stats(),
+        answer_cache=answer_cache.stats(),
+        image_cache=image_cache.stats(),
     )
 
-@app.post("/documents/upload")
+@app.get("/status", response_model=SystemStatus)
+async def get_system_status():
+    """Get system status and statistics"""
+    return await run_blocking(search_executor, system_status)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage latencies, provider errors, index size and cache hit ratios in the Prometheus text format"""
+    content = await run_blocking(search_executor, registry.render)
+    return Response(content=content, media_type=METRICS_CONTENT_TYPE)
+
+def require_debug_api():
+    if not DEBUG_API_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+@app.get("/debug/profiling")
+async def get_profiling():
+    """Sampling profiler settings"""
+    require_debug_api()
+    return profiling_settings()
+
+@app.put("/debug/profiling")
+async def update_profiling(settings: ProfilingSettings):
+    """Change the sampling profiler settings of every worker, without a restart.
+
+    Profiles of sampled requests and ingestion jobs are written to
+    PROFILE_DIR in the folded-stack format used by flame graph tools; the
+    file name is in the request's X-Profile header or the job's ``profile``.
+    """
+    require_debug_api()
+    return await run_blocking(index_executor, set_profiling, settings.sample_rate, settings.interval)
+
+@app.post("/documents/upload", status_code=202)
 async def upload_documents(files: List[UploadFile] = File(...)):
-    """Upload and process PDF documents"""
-    global faiss_index, docs_info
-    
-    if not files:
-        raise HTTPException(status_code=400, detail="No files provided")
+    """Queue PDF documents for ingestion; poll /jobs/{job_id} for progress"""
+    pdf_files = [f for f in files if f.filename.endswith('.pdf')]
+    if not pdf_files:
+        raise HTTPException(status_code=400, detail="No PDF files provided")
     
-    processed_files = []
-    new_embeddings = []
-    
-    for uploaded_file in files:
-        if not uploaded_file.filename.endswith('.pdf'):
-            continue
-            
-        try:
-            # Read file content
-            content = await uploaded_file.read()
-            await uploaded_file.seek(0)
-            
-            doc_id = str(uuid.uuid4())
-            
-            # Convert to images
-            class FileWrapper:
-                def __init__(self, content):
-                    self.content = content
-                def getvalue(self):
-                    return self.content
-            
-            file_wrapper = FileWrapper(content)
-            images = pdf_to_images(file_wrapper)
-            text = extract_text_from_pdf(file_wrapper)
-            
-            # Process text
-            if text.strip():
-                emb = get_document_embedding(text, "text")
-                if emb is not None:
-                    new_embeddings.append({"embedding": emb, "doc_id": doc_id, "content_type": "text"})
-                    docs_info.append({
-                        "doc_id": doc_id,
-                        "source": uploaded_file.filename,
-                        "content_type": "text",
-                        "content": text,
-                        "preview": text[:200] + "..." if len(text) > 200 else text,
-                    })
-            
-            # Process images
-            for page_num, img in enumerate(images, 1):
-                page_id = f"{doc_id}_page_{page_num}"
-                emb = get_document_embedding(img, "image")
-                if emb is not None:
-                    new_embeddings.append({"embedding": emb, "doc_id": page_id, "content_type": "image"})
-                    path = save_image_preview(img, f"{page_id}.png")
-                    docs_info.append({
-                        "doc_id": page_id,
-                        "source": uploaded_file.filename,
-                        "content_type": "image",
-                        "page": page_num,
-                        "preview": path,
-                    })
-            
-            processed_files.append({
-                "filename": uploaded_file.filename,
-                "doc_id": doc_id,
-                "text_pages": 1 if text.strip() else 0,
-                "image_pages": len(images)
-            })
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error processing {uploaded_file.filename}: {str(e)}")
-    
-    # Save embeddings
-    if new_embeddings:
-        save_embeddings_and_info(new_embeddings, docs_info)
-        faiss_index, _ = load_embeddings_and_info()  # Reload
+    # Copies the spooled uploads to disk; rendering and embedding run on the job workers
+    job = await run_blocking(index_executor, job_queue.submit, [(f.filename, f.file) for f in pdf_files])
     
     return {
-        "message": f"Successfully processed {len(processed_files)} documents",
-        "processed_files": processed_files,
-        "total_indexed_items": len(docs_info)
+        "message": f"Queued {len(pdf_files)} documents for processing",
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
     }
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Progress of an ingestion job, per file and page"""
+    job = await run_blocking(search_executor, job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel an ingestion job; files it already indexed are kept"""
+    job = await run_blocking(search_executor, job_queue.cancel, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+def prepare_answer(question, top_k, results):
+    """Pick the hits that fit the context budget and build the answer cache key"""
+    # Best text spans and page images within the token/pixel budget, for one LLM call
+    selection = select_context(results)
+    cache_key = answer_cache_key(question, top_k, context_key(selection), index_store.generation)
+    return selection, cache_key
+
+async def retrieve(request):
+    """Search, then select the context and cache key for the answer"""
+    results = await run_blocking(
+        search_executor,
+        search_documents,
+        request.query, 
+        index_store.index, 
+        index_store.docs_info, 
+        get_query_embedding, 
+        top_k=request.top_k,
+        nprobe=request.nprobe,
+        ef_search=request.ef_search,
+        exclude_ids=index_store.tombstones,
+        mode=request.mode or SEARCH_MODE,
+        content_type=request.content_type,
+        source=request.source,
+        doc_id_prefix=request.doc_id_prefix,
+        diversify=SEARCH_DIVERSIFY if request.diversify is None else request.diversify,
+    )
+    selection, cache_key = prepare_answer(request.query, request.top_k, results)
+    return results, selection, cache_key
+
+def format_sources(results):
+    sources = []
+    for result in results:
+        source = {
+            "doc_id": result["doc_id"],
+            "source": result["source"],
+            "content_type": result["content_type"],
+            "similarity": result["similarity"],
+            "score": result["score"],
+        }
+        source["page"] = result.get("page", 1)
+        if result["content_type"] != "image":
+            source["preview"] = result.get("preview", "")
+        sources.append(source)
+    return sources
+
+def generate_answer(question, selection, cache_key):
+    # Blocking: loads and downscales the selected page images
+    with span("context_assemble"):
+        content = assemble_context(selection)
+    return answer_with_gemini(question, content, cache_key=cache_key)
+
+def stream_answer(question, selection, cache_key):
+    with span("context_assemble"):
+        content = assemble_context(selection)
+    yield from stream_answer_with_gemini(question, content, cache_key=cache_key)
+
+async def iterate_blocking(executor, iterator):
+    """Iterate a blocking iterator from async code, one step at a time on ``executor``"""
+    done = object()
+    while True:
+        item = await run_blocking(executor, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.post("/query", response_model=QueryResponse)
 async def query_documents(request: QueryRequest):
     """Query the document collection"""
-    global faiss_index, docs_info
-    
-    if faiss_index is None:
+    if index_store.index is None:
         raise HTTPException(status_code=400, detail="No documents indexed yet")
     
-    # Search documents
-    results = search_documents(
-        request.query, 
-        faiss_index, 
-        docs_info, 
-        get_query_embedding, 
-        top_k=request.top_k
-    )
+    results, selection, cache_key = await retrieve(request)
     
     if not results:
         return QueryResponse(
             answer="No relevant results found.",
             sources=[],
             query=request.query,
-            timestamp=datetime.now().isoformat()
+            timestamp=datetime.now().isoformat(),
+            debug=request_debug(request),
         )
     
-    # Get best result for LLM
-    text_result = next((r for r in results if r['content_type'] == 'text'), None)
-    image_result = next((r for r in results if r['content_type'] == 'image'), None)
+    # Generate answer, unless this question was already answered from the same context
+    answer = await run_blocking(search_executor, answer_cache.get, cache_key)
+    if answer is None:
+        answer = await run_blocking(llm_executor, generate_answer, request.query, selection, cache_key)
     
-    # Generate answer
-    if image_result:
-        content = Image.open(image_result['preview'])
-    elif text_result:
-        content = text_result['content']
+    return QueryResponse(
+        answer=answer,
+        sources=format_sources(results),
+        query=request.query,
+        timestamp=datetime.now().isoformat(),
+        debug=request_debug(request),
+    )
+
+@app.post("/query/batch", response_model=BatchQueryResponse)
+async def query_documents_batch(request: BatchQueryRequest):
+    """Query the document collection with many questions at once.
+
+    All questions are embedded in batched calls and searched with one index
+    search; answers, if requested, are generated concurrently. Results are
+    in the order of ``queries``.
+    """
+    if index_store.index is None:
+        raise HTTPException(status_code=400, detail="No documents indexed yet")
+    if len(request.queries) > API_BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {API_BATCH_MAX_QUERIES} queries per batch")
+    
+    all_results = await run_blocking(
+        search_executor,
+        search_documents_batch,
+        request.queries,
+        index_store.index,
+        index_store.docs_info,
+        get_query_embeddings,
+        top_k=request.top_k,
+        nprobe=request.nprobe,
+        ef_search=request.ef_search,
+        exclude_ids=index_store.tombstones,
+        mode=request.mode or SEARCH_MODE,
+        content_type=request.content_type,
+        source=request.source,
+        doc_id_prefix=request.doc_id_prefix,
+        diversify=SEARCH_DIVERSIFY if request.diversify is None else request.diversify,
+    )
+    
+    semaphore = asyncio.Semaphore(API_BATCH_ANSWER_CONCURRENCY)
+    
+    async def answer(question, results):
+        if not results:
+            return "No relevant results found."
+        selection, cache_key = prepare_answer(question, request.top_k, results)
+        cached = await run_blocking(search_executor, answer_cache.get, cache_key)
+        if cached is not None:
+            return cached
+        async with semaphore:
+            return await run_blocking(llm_executor, generate_answer, question, selection, cache_key)
+    
+    if request.generate_answers:
+        answers = await asyncio.gather(*(answer(q, r) for q, r in zip(request.queries, all_results)))
     else:
-        content = ""
+        answers = [None] * len(request.queries)
     
-    answer = answer_with_gemini(request.query, content)
+    return BatchQueryResponse(
+        results=[
+            {"query": question, "answer": answer_text, "sources": format_sources(results)}
+            for question, answer_text, results in zip(request.queries, answers, all_results)
+        ],
+        timestamp=datetime.now().isoformat()
+    )
+
+@app.post("/query/stream")
+async def query_documents_stream(request: QueryRequest):
+    """Query the document collection, streaming the result as Server-Sent Events.
+
+    A ``sources`` event is sent as soon as retrieval finishes, then ``token``
+    events as Gemini generates the answer, then ``done``.
+    """
+    if index_store.index is None:
+        raise HTTPException(status_code=400, detail="No documents indexed yet")
     
-    # Format sources
-    sources = []
-    for result in results:
-        source = {
-            "doc_id": result["doc_id"],
-            "source": result["source"],
-            "content_type": result["content_type"],
-            "similarity": result["similarity"],
-        }
-        if result["content_type"] == "image":
-            source["page"] = result.get("page", 1)
+    results, selection, cache_key = await retrieve(request)
+    
+    async def events():
+        yield sse_event("sources", {"query": request.query, "sources": format_sources(results)})
+        if not results:
+            yield sse_event("token", {"text": "No relevant results found."})
         else:
-            source["preview"] = result.get("preview", "")
-        sources.append(source)
+            answer = await run_blocking(search_executor, answer_cache.get, cache_key)
+            if answer is not None:
+                yield sse_event("token", {"text": answer})
+            else:
+                tokens = stream_answer(request.query, selection, cache_key)
+                async for text in iterate_blocking(llm_executor, tokens):
+                    yield sse_event("token", {"text": text})
+        done = {"timestamp": datetime.now().isoformat()}
+        if request.debug:
+            done["debug"] = request_debug(request)
+        yield sse_event("done", done)
     
-    return QueryResponse(
-        answer=answer,
-        sources=sources,
-        query=request.query,
-        timestamp=datetime.now().isoformat()
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # X-Accel-Buffering stops nginx from holding events back
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
+@app.get("/index/recall")
+async def index_recall_report(k: int = 10, sample_size: int = 100):
+    """Recall@k and latency of the current index at several nprobe/efSearch settings versus exact search"""
+    if index_store.index is None:
+        raise HTTPException(status_code=400, detail="No documents indexed yet")
+    return await run_blocking(search_executor, recall_report, index_store.index, k=k, sample_size=sample_size)
+
 @app.get("/documents", response_model=List[DocumentInfo])
 async def list_documents():
     """List all indexed documents"""
-    global docs_info
-    
     return [
         DocumentInfo(
             doc_id=doc["doc_id"],
@@ -245,30 +492,26 @@ async def list_documents():
             page=doc.get("page"),
             preview=doc.get("preview")
         )
-        for doc in docs_info
+        for doc in index_store.docs_info
     ]
 
+def clear_index():
+    index_store.clear()
+    shutil.rmtree(PREVIEW_DIR, ignore_errors=True)
+    image_cache.clear()
+    # Full-size PNG previews written before tiered previews
+    data_dir = "data"
+    if os.path.exists(data_dir):
+        for file in os.listdir(data_dir):
+            if file.endswith('.png'):
+                os.remove(os.path.join(data_dir, file))
+
 @app.delete("/documents/clear")
 async def clear_all_documents():
     """Clear all indexed documents"""
-    global faiss_index, docs_info
-    
     try:
-        # Clear in-memory data
-        docs_info = []
-        faiss_index = None
-        
-        # Remove files
-        for file in ["data/faiss.index", "data/docs_info.pkl"]:
-            if os.path.exists(file):
-                os.remove(file)
-        
-        # Clear image previews
-        data_dir = "data"
-        if os.path.exists(data_dir):
-            for file in os.listdir(data_dir):
-                if file.endswith('.png'):
-                    os.remove(os.path.join(data_dir, file))
+        # Clear in-memory data, index files and image previews
+        await run_blocking(index_executor, clear_index)
         
         return {"message": "All documents cleared successfully"}
     
@@ -278,19 +521,13 @@ async def clear_all_documents():
 @app.delete("/documents/{doc_id}")
 async def delete_document(doc_id: str):
     """Delete a specific document"""
-    global docs_info
-    
-    # Find and remove document
-    original_count = len(docs_info)
-    docs_info = [doc for doc in docs_info if not doc["doc_id"].startswith(doc_id)]
-    
-    if len(docs_info) == original_count:
+    # Tombstones the vectors and drops their metadata; the index itself is
+    # rewritten in the background once enough entries are deleted
+    removed = await run_blocking(index_executor, index_store.remove, doc_id)
+    if not removed:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    # Note: For simplicity, we're not rebuilding the FAISS index here
-    # In production, you might want to rebuild the index after deletions
-    
-    return {"message": f"Document {doc_id} deleted successfully"}
+    return {"message": f"Document {doc_id} deleted successfully", "removed_items": removed}
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,29 +1,28 @@
 import streamlit as st
-from PIL import Image
-import uuid
 import matplotlib.pyplot as plt
 import pandas as pd
-import os
-
-from core.embeddings import get_document_embedding, get_query_embedding
-from core.document_utils import (
-    pdf_to_images,
-    extract_text_from_pdf,
-    save_image_preview,
-    load_embeddings_and_info,
-    save_embeddings_and_info,
-)
-from core.search import search_documents, answer_with_gemini
+import numpy as np
+
+from core.embeddings import get_document_embeddings, get_query_embedding
+from core.document_utils import index_pdf, IndexStore
+from core.search import search_documents, stream_answer_with_gemini, answer_cache, answer_cache_key
+from core.context import select_context, context_key, assemble_context
+from core.previews import load_image
+
+@st.cache_resource
+def get_index_store():
+    """One index per process, shared by all sessions and kept in sync with the API's changes"""
+    return IndexStore().load().watch()
 
 # Load session state
-if 'faiss_index' not in st.session_state:
-    st.session_state.faiss_index, st.session_state.docs_info = load_embeddings_and_info()
 if 'embedding_buffer' not in st.session_state:
     st.session_state.embedding_buffer = []
 
 st.set_page_config(page_title="Multimodal RAG", layout="wide")
 st.title("Multimodal Search App 🔍")
 
+index_store = get_index_store()
+
 tab1, tab2 = st.tabs(["Index Documents", "Search"])
 
 # ------------------- Tab 1: Indexing ------------------- #
@@ -37,47 +36,26 @@ with tab1:
         total_files = len(uploaded_files)
 
         new_embeddings = []
+        new_docs_info = []
 
         for i, uploaded_file in enumerate(uploaded_files):
             try:
                 status_text.text(f"Processing {uploaded_file.name}... ({i+1}/{total_files})")
-                doc_id = str(uuid.uuid4())
-                images = pdf_to_images(uploaded_file)
-                text = extract_text_from_pdf(uploaded_file)
-
-                if text.strip():
-                    emb = get_document_embedding(text, "text")
-                    if emb is not None:
-                        new_embeddings.append({"embedding": emb, "doc_id": doc_id, "content_type": "text"})
-                        st.session_state.docs_info.append({
-                            "doc_id": doc_id,
-                            "source": uploaded_file.name,
-                            "content_type": "text",
-                            "content": text,
-                            "preview": text[:200] + "..." if len(text) > 200 else text,
-                        })
-
-                for page_num, img in enumerate(images, 1):
-                    page_id = f"{doc_id}_page_{page_num}"
-                    emb = get_document_embedding(img, "image")
-                    if emb is not None:
-                        new_embeddings.append({"embedding": emb, "doc_id": page_id, "content_type": "image"})
-                        path = save_image_preview(img, f"{page_id}.png")
-                        st.session_state.docs_info.append({
-                            "doc_id": page_id,
-                            "source": uploaded_file.name,
-                            "content_type": "image",
-                            "page": page_num,
-                            "preview": path,
-                        })
+                vectors, entries, summary = index_pdf(uploaded_file, uploaded_file.name, get_document_embeddings)
+                if vectors is not None:
+                    new_embeddings.append(vectors)
+                    new_docs_info.extend(entries)
+                if summary["failed_items"]:
+                    total_items = summary["text_chunks"] + summary["image_pages"]
+                    st.warning(f"{uploaded_file.name}: {summary['failed_items']} of {total_items} items could not be embedded")
 
                 progress_bar.progress((i + 1) / total_files)
 
             except Exception as e:
                 st.error(f"Error processing {uploaded_file.name}: {e}")
 
-        save_embeddings_and_info(new_embeddings, st.session_state.docs_info)
-        st.session_state.faiss_index, _ = load_embeddings_and_info()  # Reload after save
+        if new_embeddings:
+            index_store.add(np.vstack(new_embeddings), new_docs_info)
         st.success("All documents processed and indexed!")
 
 # ------------------- Tab 2: Search ------------------- #
@@ -86,38 +64,46 @@ with tab2:
     query = st.text_input("Enter your query (e.g., What is the profit of Visa?)")
 
     if query:
-        if st.session_state.faiss_index is None:
+        if index_store.index is None:
             st.warning("No documents indexed yet.")
         else:
-            results = search_documents(query, st.session_state.faiss_index, st.session_state.docs_info, get_query_embedding, top_k=3)
+            # Two targeted searches (the query is embedded once): the best
+            # passages, and the best page image to show and send with them
+            text_results = search_documents(query, index_store.index, index_store.docs_info, get_query_embedding,
+                                            top_k=3, exclude_ids=index_store.tombstones, content_type="text")
+            image_results = search_documents(query, index_store.index, index_store.docs_info, get_query_embedding,
+                                             top_k=1, exclude_ids=index_store.tombstones, content_type="image")
+            results = text_results + image_results
             if not results:
                 st.warning("No relevant results found.")
             else:
-                text_result = next((r for r in results if r['content_type'] == 'text'), None)
-                image_result = next((r for r in results if r['content_type'] == 'image'), None)
-
-                with st.spinner("Generating LLM answer..."):
-                    if image_result:
-                        content = Image.open(image_result['preview'])
-                    elif text_result:
-                        content = text_result['content']
-                    else:
-                        content = ""
+                image_result = image_results[0] if image_results else None
 
-                    answer = answer_with_gemini(query, content)
-                    st.markdown(f"### 🤖 LLM Answer:\n**{answer}**")
+                # The answer goes above the match, but the match is shown first
+                # and the answer streams in while Gemini generates it
+                answer_box = st.empty()
 
                 if image_result:
                     st.subheader(f"🖼️ Image Match: Page {image_result['page']} from {image_result['source']}")
-                    img = Image.open(image_result['preview'])
-                    st.image(img, caption=None, width=1000)
+                    st.image(load_image(image_result), caption=None, width=1000)
+
+                selection = select_context(results)
+                cache_key = answer_cache_key(query, 3, context_key(selection), index_store.generation)
+                answer = answer_cache.get(cache_key)
+                if answer is None:
+                    answer = ""
+                    answer_box.info("Generating LLM answer...")
+                    for text in stream_answer_with_gemini(query, assemble_context(selection), cache_key=cache_key):
+                        answer += text
+                        answer_box.markdown(f"### 🤖 LLM Answer:\n**{answer}**")
+                answer_box.markdown(f"### 🤖 LLM Answer:\n**{answer.strip()}**")
 
 # ------------------- Sidebar ------------------- #
 with st.sidebar:
     st.header("Index Stats")
-    if st.session_state.faiss_index is not None and st.session_state.docs_info:
-        st.write(f"Total indexed items: {len(st.session_state.docs_info)}")
-        content_types = [doc["content_type"] for doc in st.session_state.docs_info]
+    if index_store.index is not None and index_store.docs_info:
+        st.write(f"Total indexed items: {len(index_store.docs_info)}")
+        content_types = [doc["content_type"] for doc in index_store.docs_info]
         type_counts = pd.Series(content_types).value_counts()
 
         fig, ax = plt.subplots()
@@ -126,9 +112,7 @@ with st.sidebar:
         st.pyplot(fig)
 
         if st.button("Clear All Indexed Data"):
-            st.session_state.docs_info = []
-            os.remove("data/faiss.index")
-            os.remove("data/docs_info.pkl")
+            index_store.clear()
             st.success("Cleared all indexed data.")
             st.experimental_rerun()
     else:
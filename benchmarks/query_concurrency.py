@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Throughput of the API's /query endpoint as the number of in-flight requests grows.
+
+Run against a live server:
+
+    python benchmarks/query_concurrency.py --url http://localhost:8000 --levels 1,2,4,8,16,32
+
+Each query gets a unique suffix by default so answers are not served from the
+answer cache; pass --same-query to measure the cached path instead. With a
+non-blocking request path, requests/s should rise with the concurrency level
+until the providers' rate limits are reached.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+async def run_level(client, url, query, concurrency, total, same_query, top_k):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(number):
+        nonlocal errors
+        payload = {"query": query if same_query else f"{query} (#{concurrency}-{number})", "top_k": top_k}
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post(url, json=payload)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except httpx.HTTPError as e:
+                errors += 1
+                print(f"Request failed: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(number) for number in range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "requests_per_second": len(latencies) / elapsed if elapsed else None,
+        "p50_ms": 1000 * percentile(latencies, 50) if latencies else None,
+        "p99_ms": 1000 * percentile(latencies, 99) if latencies else None,
+    }
+
+
+async def main(args):
+    levels = [int(level) for level in args.levels.split(",")]
+    url = args.url.rstrip("/") + "/query"
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    results = []
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for concurrency in levels:
+            total = max(args.requests, concurrency)
+            result = await run_level(client, url, args.query, concurrency, total, args.same_query, args.top_k)
+            print(f"concurrency={concurrency:>4}  {result['requests_per_second'] or 0:8.2f} req/s  "
+                  f"p50={result['p50_ms'] or 0:8.1f} ms  p99={result['p99_ms'] or 0:8.1f} ms  errors={result['errors']}")
+            results.append(result)
+
+    report = {"url": url, "query": args.query, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--query", default="What is the profit margin of Visa?")
+    parser.add_argument("--levels", default="1,2,4,8,16,32", help="comma-separated in-flight request counts")
+    parser.add_argument("--requests", type=int, default=64, help="requests per level")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--same-query", action="store_true", help="repeat one query (answer cache hits)")
+    parser.add_argument("--output", help="write the JSON report here")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""Offline benchmarks: rasterization, embedding batching, index build, search and the API under load.
+
+Embeddings and answers come from the deterministic fake providers
+(core/providers.py) unless --real-providers is given, so no API keys are
+needed; FAKE_* environment variables set their latency and error rate. Every
+benchmark runs in a temporary DATA_DIR and writes a JSON report with p50/p99
+latencies to --output-dir:
+
+    python benchmarks/suite.py all
+    python benchmarks/suite.py search --sizes 10000,100000,1000000 --dim 256
+    python benchmarks/suite.py api --levels 1,8,32 --uploads 4
+
+Rasterization and uploads need poppler (pdftoppm), like the application.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from query_concurrency import percentile, run_level  # noqa: E402  (same directory)
+
+
+def latency_summary(seconds):
+    """Count, p50, p99 and mean of a list of durations, in milliseconds"""
+    if not seconds:
+        return {"count": 0, "p50_ms": None, "p99_ms": None, "mean_ms": None}
+    return {
+        "count": len(seconds),
+        "p50_ms": 1000 * percentile(seconds, 50),
+        "p99_ms": 1000 * percentile(seconds, 99),
+        "mean_ms": 1000 * sum(seconds) / len(seconds),
+    }
+
+
+def write_report(args, name, results):
+    report = {
+        "benchmark": name,
+        "created_at": datetime.now().isoformat(),
+        "platform": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "providers": {"embed": os.environ.get("EMBED_PROVIDER"), "llm": os.environ.get("LLM_PROVIDER")},
+        "settings": {k: v for k, v in vars(args).items() if k not in ("func", "output_dir")},
+        "results": results,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {path}")
+    return report
+
+
+def synthetic_pdf(path, pages, seed=0):
+    """A PDF of ``pages`` scanned-looking pages with a few lines of text each"""
+    from PIL import Image, ImageDraw
+    rng = np.random.default_rng(seed)
+    images = []
+    for number in range(1, pages + 1):
+        image = Image.new("RGB", (1240, 1754), "white")
+        draw = ImageDraw.Draw(image)
+        for line in range(40):
+            words = " ".join(f"w{rng.integers(1000)}" for _ in range(12))
+            draw.text((80, 80 + 40 * line), f"Page {number}: {words}", fill="black")
+        draw.rectangle((80, 1500, 1160, 1700), outline="black", width=4)
+        images.append(image)
+    images[0].save(path, "PDF", save_all=True, append_images=images[1:], resolution=150)
+    return path
+
+
+def synthetic_vectors(count, dim, seed=0, clusters=256):
+    """Unit vectors around random centroids, closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((clusters, dim)).astype("float32")
+    vectors = np.empty((count, dim), dtype="float32")
+    for start in range(0, count, 100_000):
+        stop = min(count, start + 100_000)
+        block = centroids[rng.integers(clusters, size=stop - start)]
+        block += 0.5 * rng.standard_normal(block.shape).astype("float32")
+        vectors[start:stop] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return vectors
+
+
+# ------------------- Rasterization ------------------- #
+
+def bench_raster(args):
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    from core.document_utils import PdfDocument
+
+    path = synthetic_pdf(os.path.join(os.environ["DATA_DIR"], "raster.pdf"), args.pages)
+    results = []
+    for processes in (0, args.processes):
+        executor = None
+        if processes:
+            executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        page_times = []
+        try:
+            started = time.perf_counter()
+            with PdfDocument(path, executor=executor) as document:
+                for page in document.pages():
+                    page_started = time.perf_counter()
+                    page.image
+                    page_times.append(time.perf_counter() - page_started)
+            elapsed = time.perf_counter() - started
+            result = {"processes": processes, "pages": len(page_times), "seconds": elapsed,
+                      "pages_per_second": len(page_times) / elapsed, "page_latency": latency_summary(page_times)}
+        except Exception as e:
+            result = {"processes": processes, "error": str(e)}
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        print(f"raster processes={processes}: {result.get('pages_per_second', 0):.2f} pages/s {result.get('error', '')}")
+        results.append(result)
+    return write_report(args, "raster", results)
+
+
+# ------------------- Embedding batching ------------------- #
+
+def bench_embed(args):
+    from PIL import Image
+    from core import embeddings
+
+    calls = []
+    embed = embeddings.co_client.embed
+
+    def timed_embed(*a, **kw):
+        started = time.perf_counter()
+        try:
+            return embed(*a, **kw)
+        finally:
+            calls.append(time.perf_counter() - started)
+
+    embeddings.co_client.embed = timed_embed
+    rng = np.random.default_rng(0)
+    texts = [(" ".join(f"w{rng.integers(5000)}" for _ in range(200)), "text") for _ in range(args.items)]
+    images = [(Image.new("RGB", (256, 256), tuple(int(c) for c in rng.integers(256, size=3))), "image")
+              for _ in range(args.images)]
+    results = []
+    for name, items in (("batched", texts + images), ("one_per_call", (texts + images)[:args.single_items])):
+        calls.clear()
+        started = time.perf_counter()
+        if name == "batched":
+            vectors, ok = embeddings.get_document_embeddings(items)
+            embedded = int(ok.sum())
+        else:
+            embedded = sum(embeddings.get_document_embedding(*item) is not None for item in items)
+        elapsed = time.perf_counter() - started
+        result = {"mode": name, "items": len(items), "embedded": embedded, "seconds": elapsed,
+                  "items_per_second": len(items) / elapsed, "calls": len(calls), "call_latency": latency_summary(calls)}
+        print(f"embed {name}: {result['items_per_second']:.1f} items/s in {len(calls)} calls")
+        results.append(result)
+    return write_report(args, "embed", results)
+
+
+# ------------------- Index build ------------------- #
+
+def bench_index(args):
+    from core.index_factory import build_index
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        vectors = synthetic_vectors(size, args.dim)
+        ids = np.arange(size, dtype="int64")
+        for index_type in args.index_types.split(","):
+            started = time.perf_counter()
+            try:
+                index = build_index(vectors, index_type, ids)
+                elapsed = time.perf_counter() - started
+                result = {"size": size, "index_type": index_type, "seconds": elapsed,
+                          "vectors_per_second": size / elapsed, "ntotal": index.ntotal}
+            except Exception as e:
+                result = {"size": size, "index_type": index_type, "error": str(e)}
+            print(f"index {index_type} n={size}: {result.get('seconds', 0):.2f} s {result.get('error', '')}")
+            results.append(result)
+    return write_report(args, "index", results)
+
+
+# ------------------- search_documents ------------------- #
+
+def bench_search(args):
+    from core.index_factory import build_index, target_index_type, index_type_of
+    from core.metadata_store import DocsInfo
+    from core.search import search_documents, search_documents_batch
+
+    rng = np.random.default_rng(1)
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        vectors = synthetic_vectors(size, args.dim)
+        index_type = args.index_type if args.index_type != "auto" else target_index_type(size)
+        index = build_index(vectors, index_type, np.arange(size, dtype="int64"))
+        docs_info = DocsInfo({"vector_id": i, "doc_id": f"doc{i // 50}_chunk_{i}", "source": f"doc{i // 50}.pdf",
+                              "content_type": "text" if i % 4 else "image", "page": i % 50 + 1,
+                              "content": f"chunk {i}"} for i in range(size))
+        targets = vectors[rng.integers(size, size=args.queries)]
+        queries = targets + 0.05 * rng.standard_normal(targets.shape).astype("float32")
+        lookup = {f"q{i}": vector for i, vector in enumerate(queries)}
+        names = list(lookup)
+
+        for variant, options in (("vector", {}), ("filtered", {"content_type": "image"}),
+                                 ("diversified", {"diversify": True})):
+            latencies = []
+            for name in names:
+                started = time.perf_counter()
+                search_documents(name, index, docs_info, lookup.get, top_k=args.top_k, mode="vector", **options)
+                latencies.append(time.perf_counter() - started)
+            result = {"size": size, "index_type": index_type_of(index), "variant": variant,
+                      "latency": latency_summary(latencies), "queries_per_second": len(latencies) / sum(latencies)}
+            print(f"search n={size} {variant}: p50={result['latency']['p50_ms']:.2f} ms "
+                  f"p99={result['latency']['p99_ms']:.2f} ms")
+            results.append(result)
+
+        def embed_batch(batch):
+            return np.vstack([lookup[name] for name in batch]), np.ones(len(batch), dtype=bool)
+
+        started = time.perf_counter()
+        for start in range(0, len(names), args.batch_size):
+            search_documents_batch(names[start:start + args.batch_size], index, docs_info, embed_batch,
+                                   top_k=args.top_k, mode="vector")
+        elapsed = time.perf_counter() - started
+        results.append({"size": size, "index_type": index_type_of(index), "variant": f"batch_{args.batch_size}",
+                        "queries_per_second": len(names) / elapsed})
+        print(f"search n={size} batches of {args.batch_size}: {len(names) / elapsed:.0f} queries/s")
+        del index, docs_info, vectors
+    return write_report(args, "search", results)
+
+
+# ------------------- API end to end ------------------- #
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _seed_index(entries):
+    """Index synthetic text chunks directly, so queries have something to hit without poppler"""
+    from core.document_utils import IndexStore
+    from core.embeddings import get_document_embeddings
+
+    rng = np.random.default_rng(2)
+    docs = []
+    for i in range(entries):
+        text = " ".join(f"w{rng.integers(2000)}" for _ in range(150))
+        docs.append({"doc_id": f"seed{i // 20}_chunk_{i}", "source": f"seed{i // 20}.pdf", "content_type": "text",
+                     "page": i % 20 + 1, "content": text, "preview": text[:200]})
+    vectors, ok = get_document_embeddings([(doc["content"], "text") for doc in docs])
+    IndexStore().load().add(vectors[ok], [doc for doc, embedded in zip(docs, ok) if embedded])
+
+
+async def _uploads(client, url, pdf_path, count, concurrency):
+    import asyncio
+    semaphore = asyncio.Semaphore(concurrency)
+    with open(pdf_path, "rb") as f:
+        pdf = f.read()
+    request_times, job_times, pages, errors = [], [], 0, []
+
+    async def one(number):
+        nonlocal pages
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(url + "/documents/upload",
+                                         files=[("files", (f"bench-{number}.pdf", pdf, "application/pdf"))])
+            request_times.append(time.perf_counter() - started)
+            if response.status_code != 202:
+                errors.append(response.text)
+                return
+            status_url = url + response.json()["status_url"]
+            while True:
+                job = (await client.get(status_url)).json()
+                if job["status"] in ("completed", "failed", "cancelled"):
+                    break
+                await asyncio.sleep(0.1)
+            job_times.append(time.perf_counter() - started)
+            if job["status"] != "completed":
+                errors.append(job["files"][0].get("error") or job.get("error") or job["status"])
+            pages += sum(f.get("pages_rendered", 0) for f in job["files"])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(number) for number in range(count)))
+    elapsed = time.perf_counter() - started
+    return {"uploads": count, "concurrency": concurrency, "errors": len(errors), "error_samples": errors[:3],
+            "seconds": elapsed, "pages_indexed": pages, "pages_per_second": pages / elapsed,
+            "upload_request": latency_summary(request_times), "job_completion": latency_summary(job_times)}
+
+
+def bench_api(args):
+    import asyncio
+    import httpx
+
+    _seed_index(args.seed_entries)
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    log_path = os.path.join(os.environ["DATA_DIR"], "api.log")
+    with open(log_path, "w") as log:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api_server:app", "--port", str(port), "--workers", str(args.workers)],
+            cwd=ROOT, env=os.environ.copy(), stdout=log, stderr=subprocess.STDOUT,
+        )
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                if httpx.get(url + "/health").status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if server.poll() is not None or time.time() > deadline:
+                raise RuntimeError(f"API server did not start; see {log_path}")
+            time.sleep(0.2)
+
+        async def run():
+            levels = [int(level) for level in args.levels.split(",")]
+            limits = httpx.Limits(max_connections=max(levels + [args.upload_concurrency]))
+            async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+                upload = None
+                if args.uploads:
+                    pdf_path = synthetic_pdf(os.path.join(os.environ["DATA_DIR"], "upload.pdf"), args.pages)
+                    upload = await _uploads(client, url, pdf_path, args.uploads, args.upload_concurrency)
+                    print(f"upload: {upload['pages_per_second']:.2f} pages/s, errors={upload['errors']}")
+                queries = []
+                for concurrency in levels:
+                    result = await run_level(client, url + "/query", "w1 w2 w3 w4", concurrency,
+                                             max(args.requests, concurrency), False, 3)
+                    print(f"query concurrency={concurrency}: {result['requests_per_second'] or 0:.1f} req/s "
+                          f"p50={result['p50_ms'] or 0:.1f} ms p99={result['p99_ms'] or 0:.1f} ms")
+                    queries.append(result)
+                return {"upload": upload, "query": queries}
+
+        return write_report(args, "api", asyncio.run(run()))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+BENCHMARKS = {"raster": bench_raster, "embed": bench_embed, "index": bench_index, "search": bench_search,
+              "api": bench_api}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=list(BENCHMARKS) + ["all"])
+    parser.add_argument("--output-dir", default="benchmark-results")
+    parser.add_argument("--real-providers", action="store_true", help="call Cohere and Gemini (needs API keys)")
+    parser.add_argument("--pages", type=int, default=16, help="pages per synthetic PDF")
+    parser.add_argument("--processes", type=int, default=4, help="rasterization processes to compare with none")
+    parser.add_argument("--items", type=int, default=500, help="texts to embed")
+    parser.add_argument("--images", type=int, default=50, help="images to embed")
+    parser.add_argument("--single-items", type=int, default=50, help="items embedded one call each, for comparison")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated vector counts")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--index-types", default="flat,hnsw,ivf_flat,ivf_pq", help="types built by 'index'")
+    parser.add_argument("--index-type", default="auto", help="type searched by 'search'")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--seed-entries", type=int, default=2000, help="text chunks indexed before 'api' runs")
+    parser.add_argument("--uploads", type=int, default=4)
+    parser.add_argument("--upload-concurrency", type=int, default=2)
+    parser.add_argument("--levels", default="1,4,16,32", help="comma-separated in-flight /query counts")
+    parser.add_argument("--requests", type=int, default=64, help="/query requests per level")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+    args.output_dir = os.path.abspath(args.output_dir)
+
+    # Before anything imports config or core
+    if not args.real_providers:
+        os.environ["EMBED_PROVIDER"] = "fake"
+        os.environ["LLM_PROVIDER"] = "fake"
+    os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="rag-bench-")
+    os.environ["EMBED_CACHE_MAX_BYTES"] = "0"
+
+    for name in (BENCHMARKS if args.benchmark == "all" else [args.benchmark]):
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    main()
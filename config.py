@@ -1,21 +1,29 @@
 # config.py
 import os
-import sys
 
-# API Keys from environment variables with validation
+# Providers: "cohere" and "gemini" call the real APIs and need the keys
+# below; "fake" uses deterministic local stand-ins (see core/providers.py)
+# for offline runs and benchmarks
+EMBED_PROVIDER = os.getenv('EMBED_PROVIDER', 'cohere')
+LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'gemini')
+
+# API Keys from environment variables; placeholder values count as unset
 COHERE_API_KEY = os.getenv('COHERE_API_KEY')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+if COHERE_API_KEY == 'your_COHERE_API_KEY_here':
+    COHERE_API_KEY = None
+if GEMINI_API_KEY == 'your_GEMINI_API_KEY_here':
+    GEMINI_API_KEY = None
 
-# Check if API keys are properly set
-if not COHERE_API_KEY or COHERE_API_KEY == 'your_COHERE_API_KEY_here':
+# Missing keys are reported here; creating the provider client raises, so
+# this module can be imported without them
+if EMBED_PROVIDER == 'cohere' and not COHERE_API_KEY:
     print("ERROR: COHERE_API_KEY environment variable not set or contains placeholder value")
     print("Please set your actual Cohere API key in the .env file")
-    sys.exit(1)
 
-if not GEMINI_API_KEY or GEMINI_API_KEY == 'your_GEMINI_API_KEY_here':
+if LLM_PROVIDER == 'gemini' and not GEMINI_API_KEY:
     print("ERROR: GEMINI_API_KEY environment variable not set or contains placeholder value")
     print("Please set your actual Gemini API key in the .env file")
-    sys.exit(1)
 
 # Model configuration
 GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash-preview-04-17')
@@ -26,8 +34,12 @@ DATA_DIR = os.getenv('DATA_DIR', 'data')
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
 
+def _masked(key):
+    return '*' * (len(key) - 4) + key[-4:] if key else 'not set'
+
 print(f"✅ Configuration loaded successfully")
-print(f"   - Cohere API Key: {'*' * (len(COHERE_API_KEY) - 4) + COHERE_API_KEY[-4:]}")
-print(f"   - Gemini API Key: {'*' * (len(GEMINI_API_KEY) - 4) + GEMINI_API_KEY[-4:]}")
+print(f"   - Embedding provider: {EMBED_PROVIDER}, LLM provider: {LLM_PROVIDER}")
+print(f"   - Cohere API Key: {_masked(COHERE_API_KEY)}")
+print(f"   - Gemini API Key: {_masked(GEMINI_API_KEY)}")
 print(f"   - Gemini Model: {GEMINI_MODEL}")
 print(f"   - Data Directory: {DATA_DIR}")
@@ -0,0 +1,152 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+
+def normalize_query(query):
+    """Collapse whitespace and case so trivially different spellings share an entry"""
+    return " ".join(query.split()).lower()
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with an optional per-entry TTL (seconds)"""
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "capacity": self.max_entries,
+        }
+
+
+class DiskCache:
+    """SQLite-backed LRU cache with TTL, shared by every process using the same file"""
+
+    def __init__(self, path, max_entries, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (row[1] is not None and row[1] <= now):
+            if row is not None:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._count(hit=False)
+            return None
+        conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        self._count(hit=True)
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        now = time.time()
+        expires = now + self.ttl if self.ttl else None
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expires, now),
+        )
+        evicted = conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        ).rowcount
+        if evicted > 0:
+            with self._lock:
+                self.evictions += evicted
+
+    def clear(self):
+        self._conn().execute("DELETE FROM cache")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0],
+            "capacity": self.max_entries,
+        }
+
+
+def make_cache(backend, name, max_entries, ttl=None):
+    """Build the cache for a backend name: memory, disk (DATA_DIR/<name>.sqlite) or none"""
+    if backend == "disk":
+        return DiskCache(os.path.join(DATA_DIR, f"{name}.sqlite"), max_entries, ttl=ttl)
+    if backend == "none":
+        return LRUCache(0)
+    return LRUCache(max_entries, ttl=ttl)
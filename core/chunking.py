@@ -0,0 +1,63 @@
+import os
+import re
+
+# Chunk size and overlap, in tokens approximated as whitespace-separated words
+TEXT_CHUNK_TOKENS = int(os.getenv('TEXT_CHUNK_TOKENS', 300))
+TEXT_CHUNK_OVERLAP = int(os.getenv('TEXT_CHUNK_OVERLAP', 50))
+
+_WORD = re.compile(r"\S+")
+
+
+def count_tokens(text):
+    return sum(1 for _ in _WORD.finditer(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """The first ``max_tokens`` tokens of ``text``, keeping its original spacing"""
+    if max_tokens <= 0:
+        return ""
+    for number, match in enumerate(_WORD.finditer(text), 1):
+        if number == max_tokens:
+            return text[:match.end()]
+    return text
+
+
+def _split_page(text, max_tokens, overlap):
+    """Windows of at most max_tokens words over one page, overlapping by ``overlap`` words"""
+    spans = [m.span() for m in _WORD.finditer(text)]
+    if len(spans) <= max_tokens:
+        return [(text.strip(), len(spans))] if spans else []
+    step = max(1, max_tokens - overlap)
+    windows = []
+    for first in range(0, len(spans), step):
+        last = min(first + max_tokens, len(spans)) - 1
+        windows.append((text[spans[first][0]:spans[last][1]], last - first + 1))
+        if last == len(spans) - 1:
+            break
+    return windows
+
+
+def chunk_pages(pages, max_tokens=TEXT_CHUNK_TOKENS, overlap=TEXT_CHUNK_OVERLAP):
+    """Split ``(page_number, text)`` pairs into page-aligned chunks.
+
+    A chunk never starts mid-page: consecutive short pages are merged while they
+    fit in ``max_tokens``, and a long page is split into overlapping windows.
+    Returns dicts with ``text``, ``page`` and ``page_end``.
+    """
+    chunks = []
+    current = None
+    for page_number, text in pages:
+        for piece, size in _split_page(text, max_tokens, overlap):
+            if current and current["size"] + size <= max_tokens:
+                current["text"] += "\n" + piece
+                current["size"] += size
+                current["page_end"] = page_number
+                continue
+            if current:
+                chunks.append(current)
+            current = {"text": piece, "size": size, "page": page_number, "page_end": page_number}
+    if current:
+        chunks.append(current)
+    for chunk in chunks:
+        del chunk["size"]
+    return chunks
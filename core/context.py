@@ -0,0 +1,75 @@
+import os
+from PIL import Image
+from core.chunking import count_tokens, truncate_tokens
+from core.previews import load_image as load_page_image
+
+# Budgets for the context sent with each question: text tokens (approximated
+# as words, like chunking) and total image pixels. Page images are downscaled
+# to fit CONTEXT_IMAGE_MAX_SIDE, which keeps each one within a single 768x768
+# Gemini image tile.
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', 1500))
+CONTEXT_MAX_PIXELS = int(os.getenv('CONTEXT_MAX_PIXELS', 2 * 768 * 768))
+CONTEXT_IMAGE_MAX_SIDE = int(os.getenv('CONTEXT_IMAGE_MAX_SIDE', 768))
+# Text hits that would be cut shorter than this are skipped instead
+CONTEXT_MIN_SPAN_TOKENS = int(os.getenv('CONTEXT_MIN_SPAN_TOKENS', 40))
+
+
+def _fit(width, height, max_side):
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def select_context(results, max_tokens=CONTEXT_MAX_TOKENS, max_pixels=CONTEXT_MAX_PIXELS,
+                   max_side=CONTEXT_IMAGE_MAX_SIDE):
+    """Pick the search hits that fit the token and pixel budgets, best first.
+
+    Text hits are cut to the tokens left; page images are charged at their
+    downscaled size (the full tile when the size is unknown). Does no I/O, so
+    the selection can key the answer cache before anything is loaded.
+    """
+    selection = []
+    tokens = 0
+    pixels = 0
+    for result in sorted(results, key=lambda r: r["score"], reverse=True):
+        if result["content_type"] == "image":
+            if not result.get("preview"):
+                continue
+            size = _fit(result.get("width") or max_side, result.get("height") or max_side, max_side)
+            if pixels + size[0] * size[1] > max_pixels:
+                continue
+            pixels += size[0] * size[1]
+            selection.append({"result": result, "size": size})
+        else:
+            available = count_tokens(result.get("content") or "")
+            take = min(available, max_tokens - tokens)
+            if take <= 0 or take < min(available, CONTEXT_MIN_SPAN_TOKENS):
+                continue
+            tokens += take
+            selection.append({"result": result, "tokens": take})
+    return selection
+
+
+def context_key(selection):
+    """Identity of a selected context, for the answer cache"""
+    return "|".join(f"{item['result']['doc_id']}:{item.get('tokens', '')}" for item in selection)
+
+
+def assemble_context(selection, load_image=load_page_image):
+    """Prompt parts for a selection: labelled text spans and downscaled page images.
+
+    ``load_image`` takes a search hit; the default reads its LLM-size copy
+    through the decoded-image cache.
+    """
+    parts = []
+    for number, item in enumerate(selection, 1):
+        result = item["result"]
+        label = f"[{number}] {result['source']}, page {result.get('page', 1)}"
+        if "size" in item:
+            image = load_image(result)
+            size = _fit(*image.size, max(item["size"]))
+            if size != image.size:
+                image = image.resize(size, Image.LANCZOS)
+            parts.extend([f"{label} (page image):", image])
+        else:
+            parts.append(f"{label}:\n{truncate_tokens(result['content'], item['tokens'])}")
+    return parts
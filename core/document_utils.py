@@ -1,57 +1,806 @@
 import os
-import io
+import math
+import shutil
+import uuid
+import itertools
 import tempfile
-from PIL import Image
 import pdf2image
 import PyPDF2
+import json
+import time
 import pickle
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 import faiss
+from core.chunking import chunk_pages
+from core.tracing import span, record, traced
+from core.previews import save_preview_tiers, remove_preview_files
+from core.metadata_store import MetadataStore, DocsInfo
+from core.index_factory import (
+    LayeredIndex,
+    read_snapshot,
+    build_index,
+    compact_index,
+    all_vectors,
+    index_ids,
+    has_id,
+    index_type_of,
+    target_index_type,
+    needs_rebuild,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
 
 DATA_DIR = os.getenv('DATA_DIR', 'data')
 os.makedirs(DATA_DIR, exist_ok=True)
 
-def pdf_to_images(pdf_file):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp.write(pdf_file.getvalue())
-        tmp_path = tmp.name
+# Rasterization: pixel budget per page (Cohere's embed image limit), DPI cap,
+# pages rendered per poppler call and poppler threads
+PDF_MAX_PIXELS = int(os.getenv('PDF_MAX_PIXELS', 1568 * 1568))
+PDF_MAX_DPI = int(os.getenv('PDF_MAX_DPI', 200))
+PDF_RENDER_WINDOW = int(os.getenv('PDF_RENDER_WINDOW', 8))
+PDF_RENDER_THREADS = int(os.getenv('PDF_RENDER_THREADS', 2))
+
+# Embedding during ingestion: items handed to embed_fn at once (one full
+# embed request), and rendered pages held while their embeddings are pending
+# (about 7 MB each at the default pixel budget). Page batches are sent at half
+# the page bound, so one is embedded while the next is rendered
+PDF_EMBED_BATCH = int(os.getenv('COHERE_MAX_BATCH_INPUTS', 96))
+PDF_MAX_PENDING_PAGES = int(os.getenv('PDF_MAX_PENDING_PAGES', 32))
+
+# Delta log size that triggers a full snapshot rewrite
+INDEX_COMPACT_BYTES = int(os.getenv('INDEX_COMPACT_BYTES', 64 * 1024 * 1024))
+
+# Deleted vectors (as a fraction of the index, and at least this many) that
+# trigger a background rewrite of the index without them
+INDEX_TOMBSTONE_RATIO = float(os.getenv('INDEX_TOMBSTONE_RATIO', 0.1))
+INDEX_TOMBSTONE_MIN = int(os.getenv('INDEX_TOMBSTONE_MIN', 100))
+
+# Seconds between checks for other processes' index changes (IndexStore.watch)
+INDEX_WATCH_INTERVAL = float(os.getenv('INDEX_WATCH_INTERVAL', 1.0))
+INDEX_MMAP = os.getenv('INDEX_MMAP', 'true').lower() in ('1', 'true', 'yes')
+
+MANIFEST_FILE = "index.manifest"
+SNAPSHOT_FILE = "index-{version:06d}.faiss"
+VERSION_DELTA_FILE = "index-{version:06d}.delta"
+METADATA_FILE = "docs.sqlite"
+LOCK_FILE = "index.lock"
+GENERATION_FILE = "index.generation"
+# Files from older versions, migrated on load
+INDEX_FILE = "faiss.index"
+DELTA_FILE = "index.delta"
+DOCS_FILE = "docs_info.pkl"
+
+def _fit_dpi(page, max_pixels, max_dpi):
+    """Largest DPI (up to max_dpi) at which the page renders within max_pixels"""
+    width = float(page.mediabox.width)
+    height = float(page.mediabox.height)
+    if width <= 0 or height <= 0:
+        return max_dpi
+    return max(1, min(max_dpi, int(72 * math.sqrt(max_pixels / (width * height)))))
+
+def _render_window(path, runs, thread_count):
+    """Render ``(dpi, first_page, last_page)`` runs with poppler; top-level so a process pool can run it.
+
+    Returns the images and the seconds spent rendering, which the caller
+    records (a pool worker's metrics would not reach the parent).
+    """
+    started = time.perf_counter()
+    images = []
+    for dpi, first, last in runs:
+        images.extend(pdf2image.convert_from_path(
+            path, dpi=dpi, first_page=first, last_page=last, thread_count=thread_count,
+        ))
+    return images, time.perf_counter() - started
+
+class PdfPage:
+    """One page of a PdfDocument; ``image`` is rendered on first access"""
+
+    def __init__(self, document, number, text):
+        self.document = document
+        self.number = number
+        self.text = text
+
+    @property
+    def image(self):
+        return self.document.render(self.number)
+
+
+class PdfDocument:
+    """A PDF parsed once, from a path or a file-like upload.
+
+    A single PyPDF2 reader over the original stream supplies per-page text and
+    page sizes. Page images are rendered ``window`` pages per poppler call, each
+    directly at the DPI that fits ``max_pixels``, and only the current window
+    is kept, so peak memory does not depend on the page count. Poppler needs a
+    filesystem path; uploads that are not already on disk are spooled to a
+    temporary file once, the first time a page is rendered.
+
+    With an ``executor`` (e.g. a process pool) windows are rendered there, and
+    the next window is requested as soon as the current one arrives so
+    rendering overlaps with whatever the caller does with the pages.
+    """
+
+    def __init__(self, source, max_pixels=PDF_MAX_PIXELS, max_dpi=PDF_MAX_DPI,
+                 window=PDF_RENDER_WINDOW, thread_count=PDF_RENDER_THREADS, executor=None):
+        self.max_pixels = max_pixels
+        self.max_dpi = max_dpi
+        self.window = window
+        self.thread_count = thread_count
+        self.executor = executor
+        self._prefetch = None
+        self._temp_path = None
+        if isinstance(source, (str, os.PathLike)):
+            self._path = os.fspath(source)
+            self._stream = open(self._path, "rb")
+            self._owns_stream = True
+        else:
+            name = getattr(source, "name", None)
+            on_disk = isinstance(name, str) and os.path.isabs(name) and os.path.isfile(name)
+            self._path = name if on_disk else None
+            self._stream = source
+            self._owns_stream = False
+            self._stream.seek(0)
+        try:
+            self.reader = PyPDF2.PdfReader(self._stream)
+        except Exception:
+            # A corrupt file: nothing else will close the stream we opened
+            if self._owns_stream:
+                self._stream.close()
+            raise
+        self._dpis = None
+        self._window_images = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._window_images = {}
+        if self._prefetch is not None:
+            self._prefetch[1].cancel()
+            self._prefetch = None
+        if self._owns_stream:
+            self._stream.close()
+        if self._temp_path:
+            os.unlink(self._temp_path)
+            self._temp_path = None
+
+    def __len__(self):
+        return len(self.reader.pages)
 
-    images = pdf2image.convert_from_path(tmp_path, dpi=200)
-    os.unlink(tmp_path)
-    return images
+    def pages(self):
+        for number, page in enumerate(self.reader.pages, 1):
+            try:
+                with span("text_extract"):
+                    text = page.extract_text() or ""
+            except Exception as e:
+                print(f"Text extraction error on page {number}: {e}")
+                text = ""
+            yield PdfPage(self, number, text)
+
+    def text(self):
+        return "\n".join(page.text for page in self.pages() if page.text)
+
+    def _render_path(self):
+        if self._path is None:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+                self._stream.seek(0)
+                shutil.copyfileobj(self._stream, tmp)
+            self._path = self._temp_path = tmp.name
+        return self._path
+
+    def _window_runs(self, first):
+        """One ``(dpi, first_page, last_page)`` poppler call per run of pages sharing a DPI"""
+        if self._dpis is None:
+            self._dpis = [_fit_dpi(page, self.max_pixels, self.max_dpi) for page in self.reader.pages]
+        runs = []
+        page_num = first
+        for dpi, run in itertools.groupby(self._dpis[first - 1:first - 1 + self.window]):
+            count = len(list(run))
+            runs.append((dpi, page_num, page_num + count - 1))
+            page_num += count
+        return runs
+
+    def _submit_window(self, first):
+        return self.executor.submit(_render_window, self._render_path(), self._window_runs(first), self.thread_count)
+
+    def render(self, number):
+        """Image of page ``number`` (1-based), rendering its window if needed"""
+        if number not in self._window_images:
+            if self.executor is None:
+                images, elapsed = _render_window(self._render_path(), self._window_runs(number), self.thread_count)
+            else:
+                if self._prefetch is not None and self._prefetch[0] == number:
+                    future = self._prefetch[1]
+                else:
+                    if self._prefetch is not None:
+                        self._prefetch[1].cancel()
+                    future = self._submit_window(number)
+                self._prefetch = None
+                images, elapsed = future.result()
+                following = number + len(images)
+                if images and following <= len(self):
+                    self._prefetch = (following, self._submit_window(following))
+            if images:
+                record("pdf_render", elapsed, count=len(images))
+            self._window_images = dict(enumerate(images, number))
+        return self._window_images[number]
+
+def iter_pdf_images(pdf_file, **options):
+    """Yield (page_number, image) pairs for a PDF path or file-like upload"""
+    with PdfDocument(pdf_file, **options) as document:
+        for page in document.pages():
+            yield page.number, page.image
 
 def extract_text_from_pdf(pdf_file):
     try:
-        reader = PyPDF2.PdfReader(io.BytesIO(pdf_file.getvalue()))
-        return "\n".join([page.extract_text() for page in reader.pages if page.extract_text()])
+        with PdfDocument(pdf_file) as document:
+            return document.text()
     except Exception as e:
         print(f"Text extraction error: {e}")
         return ""
 
-def save_image_preview(image, filename):
-    path = os.path.join(DATA_DIR, filename)
-    image.save(path)
-    return path
+def index_pdf(pdf_file, source, embed_fn, window=PDF_RENDER_WINDOW, executor=None, progress=None,
+              batch_size=PDF_EMBED_BATCH, max_pending_pages=PDF_MAX_PENDING_PAGES):
+    """Extract, render and embed one PDF (path or file-like), a window of pages at a time.
 
-def save_embeddings_and_info(embeddings_data, docs_info):
-    vectors = [item["embedding"].astype("float32") for item in embeddings_data]
-    index = faiss.IndexFlatL2(len(vectors[0]))
-    index.add(np.vstack(vectors))
-    faiss.write_index(index, os.path.join(DATA_DIR, "faiss.index"))
+    ``embed_fn`` takes ``(content, content_type)`` items and returns an
+    embedding matrix and a mask of embedded rows (get_document_embeddings).
+    Pages are rendered on ``executor`` when given. Embedding runs in the
+    background while later pages render: items go to ``embed_fn`` in batches
+    of up to ``batch_size`` (page batches of half ``max_pending_pages``), and
+    rendering waits only when ``max_pending_pages`` page images are waiting
+    for their embeddings. ``progress(summary)`` is called after every page and
+    every embedded batch; an exception it raises (e.g. to cancel) aborts the
+    file and removes the previews saved so far. Returns the matrix of new
+    vectors (or None), their docs_info entries and a per-file summary.
+    """
+    doc_id = str(uuid.uuid4())
+    summary = {"doc_id": doc_id, "pages": 0, "pages_rendered": 0, "text_pages": 0, "text_chunks": 0,
+               "image_pages": 0, "embedded_items": 0, "failed_items": 0}
+    vectors = []
+    entries = []
+    items = []
+    pending = []
+    # Submitted batches, oldest first: (future, items, entries, page count)
+    in_flight = deque()
+    page_batch = max(1, min(batch_size, max_pending_pages // 2))
+    embed_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf-embed")
 
-    with open(os.path.join(DATA_DIR, "docs_info.pkl"), "wb") as f:
-        pickle.dump(docs_info, f)
+    def submit():
+        if not items:
+            return
+        batch, batch_entries = list(items), list(pending)
+        pages = sum(1 for _, content_type in batch if content_type == "image")
+        in_flight.append((embed_pool.submit(traced(embed_fn), batch), batch, batch_entries, pages))
+        items.clear()
+        pending.clear()
 
-def load_embeddings_and_info():
-    index_path = os.path.join(DATA_DIR, "faiss.index")
-    docs_path = os.path.join(DATA_DIR, "docs_info.pkl")
+    def collect():
+        """Wait for the oldest batch and keep its embedded entries (in submission order)"""
+        future, batch, batch_entries, _ = in_flight.popleft()
+        batch_vectors, ok = future.result()
+        for (content, content_type), entry, embedded in zip(batch, batch_entries, ok):
+            if not embedded:
+                continue
+            if content_type == "image":
+                entry.update(save_preview_tiers(content, entry["doc_id"]))
+                entry["width"], entry["height"] = content.size
+            entries.append(entry)
+        if ok.any():
+            vectors.append(batch_vectors[ok])
+        summary["embedded_items"] += int(ok.sum())
+        summary["failed_items"] += int(len(batch) - ok.sum())
+        report()
+
+    def held_pages():
+        return len(items) + sum(pages for *_, pages in in_flight)
+
+    def report():
+        if progress is not None:
+            progress(summary)
+
+    try:
+        page_texts = []
+        with PdfDocument(pdf_file, window=window, executor=executor) as document:
+            summary["pages"] = len(document)
+            report()
+            for page in document.pages():
+                if page.text.strip():
+                    page_texts.append((page.number, page.text))
+                items.append((page.image, "image"))
+                pending.append({
+                    "doc_id": f"{doc_id}_page_{page.number}",
+                    "source": source,
+                    "content_type": "image",
+                    "page": page.number,
+                })
+                summary["image_pages"] += 1
+                summary["pages_rendered"] += 1
+                report()
+                if len(items) >= page_batch:
+                    submit()
+                while in_flight and (in_flight[0][0].done() or held_pages() > max_pending_pages):
+                    collect()
+
+        # Each text chunk is its own entry so retrieval returns just the relevant passage
+        chunks = chunk_pages(page_texts)
+        for chunk_num, chunk in enumerate(chunks, 1):
+            items.append((chunk["text"], "text"))
+            pending.append({
+                "doc_id": f"{doc_id}_chunk_{chunk_num}",
+                "source": source,
+                "content_type": "text",
+                "page": chunk["page"],
+                "page_end": chunk["page_end"],
+                "content": chunk["text"],
+                "preview": chunk["text"][:200] + "..." if len(chunk["text"]) > 200 else chunk["text"],
+            })
+            if len(items) >= batch_size:
+                submit()
+        summary["text_pages"] = len(page_texts)
+        summary["text_chunks"] = len(chunks)
+        submit()
+        while in_flight:
+            collect()
+    except BaseException:
+        # Nothing from a failed or cancelled file is indexed; drop its previews
+        for entry in entries:
+            if entry["content_type"] == "image":
+                remove_preview_files(entry)
+        raise
+    finally:
+        # Batches still queued when the file fails are dropped; running ones finish in the background
+        embed_pool.shutdown(wait=False, cancel_futures=True)
+
+    return (np.vstack(vectors) if vectors else None), entries, summary
+
+class IndexStore:
+    """FAISS index plus docs_info metadata, shared by every process using DATA_DIR.
+
+    On disk the index is a versioned snapshot (``index-<version>.faiss``) plus
+    an append-only log of changes made since (``index-<version>.delta``);
+    ``index.manifest`` names the current version and is replaced atomically,
+    so a snapshot and its log always switch together. Snapshots are loaded
+    read-only, memory-mapped where FAISS supports it, and vectors added since
+    live in a small in-memory layer (LayeredIndex). The log is folded into a
+    new snapshot once it grows past ``INDEX_COMPACT_BYTES``.
+
+    Other processes' changes are picked up by ``refresh()``, which ``watch()``
+    runs in the background. Vector ids are the docs_info entries'
+    ``vector_id``; metadata rows live in ``docs.sqlite`` and ``docs_info``
+    holds only the small fields, fetching text through ``docs_info.content()``.
+
+    Deleted vectors are tombstoned (a small "remove" record in the log) and
+    skipped at search time; a background compaction rewrites the index without
+    them once they pass ``INDEX_TOMBSTONE_RATIO`` of the index.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.metadata = MetadataStore(self._path(METADATA_FILE))
+        # LayeredIndex (or a freshly rebuilt index about to be snapshotted);
+        # never modified in place, so searches can keep the one they started with
+        self.index = None
+        self.docs_info = DocsInfo(metadata=self.metadata)
+        # vector_ids deleted but still physically in the index; replaced, never
+        # mutated, for the same reason
+        self.tombstones = frozenset()
+        # Bumped on every change to the indexed contents, shared across processes
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._version = 0
+        self._delta_offset = 0
+        self._next_id = 0
+        self._docs_loaded = 0
+        self._compactor = None
+        self._watcher = None
+        self._stop_watching = threading.Event()
+
+    def _path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def _delta_path(self, version=None):
+        return self._path(VERSION_DELTA_FILE.format(version=self._version if version is None else version))
+
+    @contextmanager
+    def _file_lock(self, shared=False):
+        """Serialise writers (and readers against writers) across threads and processes sharing DATA_DIR"""
+        with self._lock, open(self._path(LOCK_FILE), "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-    if os.path.exists(index_path) and os.path.exists(docs_path):
-        index = faiss.read_index(index_path)
+    def load(self):
+        with self._file_lock():
+            if not os.path.exists(self._path(MANIFEST_FILE)):
+                self._migrate_legacy_index()
+            with span("index_load"):
+                self._load_snapshot()
+                self._replay_delta()
+            self._maybe_rebuild()
+        return self
+
+    def refresh(self):
+        """Pick up changes made by other processes; cheap when there are none"""
+        try:
+            delta_size = os.path.getsize(self._delta_path())
+        except OSError:
+            delta_size = 0
+        if (self._read_manifest()["version"] == self._version and delta_size <= self._delta_offset
+                and self._read_generation() == self.generation):
+            return False
+        with self._file_lock(shared=True):
+            self._replay_delta()
+        return True
+
+    def watch(self, interval=INDEX_WATCH_INTERVAL):
+        """Refresh every ``interval`` seconds in a background thread"""
+        if self._watcher is not None and self._watcher.is_alive():
+            return self
+        self._stop_watching.clear()
+
+        def run():
+            while not self._stop_watching.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Index refresh error: {e}")
+
+        self._watcher = threading.Thread(target=run, name="index-watcher", daemon=True)
+        self._watcher.start()
+        return self
+
+    def stop_watching(self):
+        self._stop_watching.set()
+
+    @property
+    def index_type(self):
+        return index_type_of(self.index)
+
+    def _maybe_rebuild(self):
+        """Switch index type (e.g. flat -> HNSW) once the corpus crosses the configured size"""
+        if self.index is None:
+            return
+        target = target_index_type(self.index.ntotal - len(self.tombstones), self.index_type)
+        if needs_rebuild(self.index, target):
+            print(f"Rebuilding {self.index_type} index as {target} ({self.index.ntotal} vectors)")
+            self._rebuild(target)
+            self._write_snapshot()
+
+    def _rebuild(self, index_type=None):
+        """Rebuild the index from its live vectors, dropping tombstoned ones"""
+        if index_type is None:
+            index_type = target_index_type(self.index.ntotal - len(self.tombstones), self.index_type)
+        if not needs_rebuild(self.index, index_type):
+            # Same type and size: drop tombstones without retraining (see compact_index)
+            self.index = compact_index(self.index, self.tombstones)
+        else:
+            ids, vectors = all_vectors(self.index)
+            if self.tombstones:
+                keep = ~np.isin(ids, np.fromiter(self.tombstones, dtype="int64", count=len(self.tombstones)))
+                ids, vectors = ids[keep], vectors[keep]
+            self.index = build_index(vectors, index_type, ids)
+        self.tombstones = frozenset()
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"version": 0, "snapshot": None}
+
+    def _load_snapshot(self):
+        """Load the current snapshot and its log, then switch to them all at once.
+
+        Everything is built aside first, so searches during a reload keep
+        using the previous index and metadata instead of a half-loaded store.
+        """
+        manifest = self._read_manifest()
+        index = None
+        if manifest["snapshot"]:
+            index = read_snapshot(self._path(manifest["snapshot"]), mmap=INDEX_MMAP)
+        next_id = int(index_ids(index).max()) + 1 if index is not None and index.ntotal else 0
+        docs_info = DocsInfo(metadata=self.metadata)
+        tombstones = frozenset()
+        offset = 0
+        path = self._delta_path(manifest["version"])
+        if os.path.exists(path):
+            records, offset = self._read_records(path, 0)
+            index, tombstones, next_id = self._applied(records, index, docs_info, tombstones, next_id)
+        docs_info.extend(entry for entry in self.metadata.load(0, next_id) if entry["vector_id"] not in tombstones)
+        generation = self._read_generation()
+
+        with self._lock:
+            self.index, self.docs_info, self.tombstones = index, docs_info, tombstones
+            self._version = manifest["version"]
+            self._next_id = self._docs_loaded = next_id
+            self._delta_offset = offset
+            self.generation = generation
+
+    def _migrate_legacy_index(self):
+        """Fold a faiss.index / index.delta / docs_info.pkl from older versions into a versioned snapshot"""
+        index_path = self._path(INDEX_FILE)
+        delta_path = self._path(DELTA_FILE)
+        if not any(os.path.exists(self._path(name)) for name in (INDEX_FILE, DELTA_FILE, DOCS_FILE)):
+            return
+        self._load_snapshot()
+        if os.path.exists(index_path):
+            self.index = LayeredIndex(faiss.read_index(index_path))
+            self._next_id = int(index_ids(self.index).max()) + 1 if self.index.ntotal else 0
+        self._migrate_pickled_docs()
+        if os.path.exists(delta_path):
+            self._apply_records(self._read_records(delta_path, 0)[0], dedupe=True)
+        if self.index is not None:
+            self._rebuild()
+            self._write_snapshot()
+        for name in (INDEX_FILE, DELTA_FILE):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+
+    def _migrate_pickled_docs(self):
+        """Move a docs_info.pkl from older versions into the metadata store"""
+        docs_path = self._path(DOCS_FILE)
+        if not os.path.exists(docs_path):
+            return
         with open(docs_path, "rb") as f:
             docs_info = pickle.load(f)
-    else:
-        index = None
-        docs_info = []
+        ntotal = self.index.ntotal if self.index is not None else 0
+        if ntotal < len(docs_info):
+            # Snapshots written before the delta log only held the vectors of the
+            # last upload, which belong to the tail of docs_info.
+            print(f"Index holds {ntotal} vectors for {len(docs_info)} entries; "
+                  f"keeping the last {ntotal}, re-upload older documents to restore them")
+            docs_info = docs_info[len(docs_info) - ntotal:]
+        for vector_id, doc in enumerate(docs_info):
+            doc["vector_id"] = vector_id
+        self.metadata.append(docs_info)
+        os.replace(docs_path, docs_path + ".migrated")
+
+    def _sync_docs(self):
+        """Load metadata for vectors added since the last sync (small fields only)"""
+        if self._docs_loaded < self._next_id:
+            entries = self.metadata.load(self._docs_loaded, self._next_id)
+            self.docs_info.extend(entry for entry in entries if entry["vector_id"] not in self.tombstones)
+            self._docs_loaded = self._next_id
+
+    def _read_records(self, path, offset):
+        """Complete records in a delta log from ``offset``, and the offset after the last one"""
+        records = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except Exception as e:
+                    print(f"Index delta log is truncated at byte {offset}: {e}")
+                    break
+                offset = f.tell()
+        return records, offset
+
+    def _replay_delta(self):
+        """Apply log records written since the last replay, including other processes' changes"""
+        if self._read_manifest()["version"] != self._version:
+            # Another process wrote a new snapshot (or cleared the index)
+            self._load_snapshot()
+        path = self._delta_path()
+        if os.path.exists(path):
+            records, self._delta_offset = self._read_records(path, self._delta_offset)
+            self._apply_records(records)
+        self._sync_docs()
+        self.generation = self._read_generation()
+
+    def _apply_records(self, records, dedupe=False):
+        """Apply log records; all added vectors go into the index in one step"""
+        self.index, self.tombstones, self._next_id = self._applied(
+            records, self.index, self.docs_info, self.tombstones, self._next_id, dedupe,
+        )
+
+    def _applied(self, records, index, docs_info, tombstones, next_id, dedupe=False):
+        """``(index, tombstones, next_id)`` after log records; removed entries are dropped from ``docs_info``"""
+        added_ids = []
+        added_vectors = []
+        for log_record in records:
+            if log_record.get("op") == "remove":
+                tombstones = tombstones.union(log_record["ids"])
+                docs_info.remove(log_record["ids"])
+                continue
+            vectors = log_record["vectors"]
+            ids = log_record.get("ids")
+            if ids is None:
+                # Records from older versions were positional
+                ids = np.arange(log_record["start"], log_record["start"] + len(vectors), dtype="int64")
+            if dedupe and index is not None:
+                # Older logs could overlap their snapshot after an interrupted compaction
+                missing = np.array([not has_id(index, i) for i in ids], dtype=bool)
+                ids, vectors = ids[missing], vectors[missing]
+            added_ids.append(ids)
+            added_vectors.append(vectors)
+            if "docs_info" in log_record:
+                # Records from older versions carried their metadata inline
+                self.metadata.append(log_record["docs_info"])
 
-    return index, docs_info
+        if added_ids:
+            ids = np.concatenate(added_ids)
+            vectors = np.vstack(added_vectors)
+            if index is None:
+                index = LayeredIndex(build_index(np.zeros((0, vectors.shape[1]), dtype="float32"), "flat"))
+            if len(ids):
+                index = index.with_added(vectors, ids)
+                next_id = max(next_id, int(ids.max()) + 1)
+        return index, tombstones, next_id
+
+    def _append_record(self, log_record):
+        with open(self._delta_path(), "ab") as f:
+            # Drop a torn record left behind by a crashed writer
+            f.truncate(self._delta_offset)
+            pickle.dump(log_record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            self._delta_offset = f.tell()
+
+    def add(self, embeddings, new_docs_info):
+        """Append an embedding matrix and its docs_info entries (one per row) to the index"""
+        if len(embeddings) == 0:
+            return
+
+        vectors = np.ascontiguousarray(embeddings, dtype="float32")
+        with self._file_lock():
+            self._replay_delta()
+            ids = np.arange(self._next_id, self._next_id + len(vectors), dtype="int64")
+            for vector_id, doc in zip(ids, new_docs_info):
+                doc["vector_id"] = int(vector_id)
+            # Metadata first: rows without vectors are ignored and later overwritten
+            self.metadata.append(new_docs_info)
+            log_record = {"op": "add", "ids": ids, "vectors": vectors}
+            self._append_record(log_record)
+            self._apply_records([log_record])
+            self.docs_info.extend({k: v for k, v in doc.items() if k != "content"} for doc in new_docs_info)
+            self._docs_loaded = self._next_id
+            self._bump_generation()
+
+            self._maybe_rebuild()
+            if self._delta_offset > INDEX_COMPACT_BYTES:
+                self._write_snapshot()
+
+    def remove(self, doc_id_prefix):
+        """Delete every entry whose doc_id starts with ``doc_id_prefix``; returns how many were removed.
+
+        Costs O(removed): the vectors are tombstoned and left for compaction.
+        """
+        with self._file_lock():
+            self._replay_delta()
+            ids = self.metadata.find(doc_id_prefix)
+            if not ids:
+                return 0
+            # Tombstone first: a crash before the metadata delete leaves rows
+            # that are never loaded, rather than live vectors without metadata
+            log_record = {"op": "remove", "ids": ids}
+            self._append_record(log_record)
+            removed = self.docs_info.remove(ids)
+            self._apply_records([log_record])
+            self.metadata.delete(ids)
+            self._bump_generation()
+
+            for doc in removed:
+                if doc.get("content_type") == "image":
+                    remove_preview_files(doc)
+
+            if len(self.tombstones) >= max(INDEX_TOMBSTONE_MIN, INDEX_TOMBSTONE_RATIO * self.index.ntotal):
+                self._compact_in_background()
+            return len(ids)
+
+    def _compact_in_background(self):
+        if self._compactor is None or not self._compactor.is_alive():
+            self._compactor = threading.Thread(target=self.compact, name="index-compaction", daemon=True)
+            self._compactor.start()
+
+    def compact(self):
+        """Fold the delta log and any tombstones into a fresh snapshot"""
+        with self._file_lock():
+            self._replay_delta()
+            if self.index is not None and (self.tombstones or self._delta_offset):
+                self._write_snapshot()
+
+    def _write_snapshot(self):
+        """Write the index as the next snapshot version and switch the manifest to it"""
+        with span("index_save"):
+            self._write_snapshot_file()
+
+    def _write_snapshot_file(self):
+        if self.tombstones:
+            self._rebuild()
+        if isinstance(self.index, LayeredIndex):
+            # Fold the recent layer into an in-memory copy of the snapshot; the
+            # loaded (possibly memory-mapped) one is read-only
+            snapshot = self._read_manifest()["snapshot"]
+            if snapshot:
+                full = faiss.read_index(self._path(snapshot))
+            else:
+                full = build_index(np.zeros((0, self.index.d), dtype="float32"), "flat")
+            ids, vectors = all_vectors(self.index.recent)
+            if len(ids):
+                full.add_with_ids(vectors, ids)
+            self.index = full
+
+        version = self._version + 1
+        snapshot = SNAPSHOT_FILE.format(version=version)
+        faiss.write_index(self.index, self._path(snapshot) + ".tmp")
+        os.replace(self._path(snapshot) + ".tmp", self._path(snapshot))
+        open(self._delta_path(version), "wb").close()
+        self._switch_manifest(version, snapshot)
+
+        self._delta_offset = 0
+        self.index = read_snapshot(self._path(snapshot), mmap=INDEX_MMAP)
+
+    def _switch_manifest(self, version, snapshot):
+        """Atomically make ``version`` current, then drop older snapshots and logs"""
+        path = self._path(MANIFEST_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"version": version, "snapshot": snapshot}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self._version = version
+        # Processes still using an old snapshot keep their mapping after the unlink
+        for name in os.listdir(self.data_dir):
+            if name.startswith("index-") and name not in (snapshot, os.path.basename(self._delta_path(version))):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._file_lock():
+            for name in (INDEX_FILE, DOCS_FILE, DELTA_FILE):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            self.metadata.clear()
+            # A new, empty version tells other processes to drop their copy
+            self._switch_manifest(self._version + 1, None)
+            self.index = None
+            self.docs_info = DocsInfo(metadata=self.metadata)
+            self.tombstones = frozenset()
+            self._next_id = 0
+            self._docs_loaded = 0
+            self._delta_offset = 0
+            self._bump_generation()
+
+    def bump_generation(self):
+        """Mark the indexed contents as changed so cached answers are not reused"""
+        with self._file_lock():
+            self._bump_generation()
+
+    def _read_generation(self):
+        try:
+            with open(self._path(GENERATION_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _bump_generation(self):
+        self.generation = max(self.generation, self._read_generation()) + 1
+        path = self._path(GENERATION_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(self.generation))
+        os.replace(path + ".tmp", path)
+
+def load_embeddings_and_info():
+    store = IndexStore().load()
+    return store.index, store.docs_info
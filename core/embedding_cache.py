@@ -0,0 +1,185 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
+
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# Disk budget for cached vectors; 0 disables the cache
+EMBED_CACHE_MAX_BYTES = int(os.getenv('EMBED_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+DIGEST_SIZE = 32
+
+
+def content_key(content, content_type, model, input_type):
+    """Digest of the normalized text or the page pixels, plus model and input_type"""
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    h.update(f"{model}\0{input_type}\0{content_type}\0".encode())
+    if content_type == "text":
+        h.update(" ".join(content.split()).encode("utf-8"))
+    else:
+        h.update(f"{content.mode}\0{content.size[0]}x{content.size[1]}\0".encode())
+        h.update(content.tobytes())
+    return h.digest()
+
+
+class EmbeddingCache:
+    """Content-addressed, size-bounded LRU cache of embeddings on disk.
+
+    Vectors live in a fixed-size memory-mapped float32 file, one slot per
+    entry, next to a memory-mapped copy of each slot's key so a lookup through
+    a stale slot map (another process evicted and reused the slot) is detected
+    as a miss. The key -> slot map, in LRU order, is pickled after each write.
+
+    Reads take no file lock. A writer reusing a slot clears its key, writes the
+    vector, then writes the new key; a reader checks the key both before and
+    after copying the vector, so it never returns another entry's vector.
+    """
+
+    def __init__(self, cache_dir, max_bytes=EMBED_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._slots = OrderedDict()
+        self._dim = None
+        self._capacity = 0
+        self._vectors = None
+        self._keys = None
+        self._map_stat = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    @contextmanager
+    def _file_lock(self):
+        with self._lock, open(self._path("cache.lock"), "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """(Re)load the slot map and memmaps if another process rewrote them"""
+        map_path = self._path("slots.pkl")
+        if not os.path.exists(map_path):
+            return
+        stat = os.stat(map_path)
+        current = (stat.st_ino, stat.st_mtime_ns)
+        if current == self._map_stat:
+            return
+        try:
+            with open(map_path, "rb") as f:
+                meta = pickle.load(f)
+        except Exception as e:
+            print(f"Embedding cache map unreadable, ignoring it: {e}")
+            return
+        self._map_stat = current
+        self._slots = meta["slots"]
+        if meta["dim"] != self._dim or meta["capacity"] != self._capacity:
+            self._open(meta["dim"], meta["capacity"])
+
+    def _open(self, dim, capacity):
+        self._dim = dim
+        self._capacity = capacity
+        shapes = {"vectors.f32": ("float32", (capacity, dim)), "keys.bin": ("uint8", (capacity, DIGEST_SIZE))}
+        maps = {}
+        for name, (dtype, shape) in shapes.items():
+            path = self._path(name)
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                with open(path, "wb") as f:
+                    f.truncate(size)  # sparse until slots are written
+            maps[name] = np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+        self._vectors = maps["vectors.f32"]
+        self._keys = maps["keys.bin"]
+
+    def get_many(self, keys):
+        """Cached vector for each key, or None"""
+        results = [None] * len(keys)
+        if not self.enabled:
+            return results
+        with self._lock:
+            self._refresh()
+            for i, key in enumerate(keys):
+                slot = self._slots.get(key)
+                vector = None
+                if slot is not None and self._keys[slot].tobytes() == key:
+                    vector = np.array(self._vectors[slot])
+                    if self._keys[slot].tobytes() != key:
+                        # Another process reused the slot while we copied it
+                        vector = None
+                if vector is not None:
+                    self._slots.move_to_end(key)
+                    results[i] = vector
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return results
+
+    def put_many(self, keys, vectors):
+        if not self.enabled or not keys:
+            return
+        vectors = np.asarray(vectors, dtype="float32")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._file_lock():
+            self._refresh()
+            if self._dim is None:
+                self._open(vectors.shape[1], max(1, self.max_bytes // (vectors.shape[1] * 4 + DIGEST_SIZE)))
+            elif vectors.shape[1] != self._dim:
+                print(f"Embedding cache holds {self._dim}-d vectors, not caching {vectors.shape[1]}-d ones")
+                return
+
+            used = set(self._slots.values())
+            free = (slot for slot in range(self._capacity) if slot not in used)
+            for key, vector in zip(keys, vectors):
+                if key in self._slots:
+                    self._slots.move_to_end(key)
+                    continue
+                slot = next(free, None)
+                if slot is None:
+                    _, slot = self._slots.popitem(last=False)
+                    self.evictions += 1
+                # Key last, so lock-free readers never pair it with a half-written vector
+                self._keys[slot] = 0
+                self._vectors[slot] = vector
+                self._keys[slot] = np.frombuffer(key, dtype="uint8")
+                self._slots[key] = slot
+            self._vectors.flush()
+            self._keys.flush()
+
+            map_path = self._path("slots.pkl")
+            with open(map_path + ".tmp", "wb") as f:
+                pickle.dump({"dim": self._dim, "capacity": self._capacity, "slots": self._slots}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(map_path + ".tmp", map_path)
+            stat = os.stat(map_path)
+            self._map_stat = (stat.st_ino, stat.st_mtime_ns)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._slots),
+            "capacity": self._capacity,
+        }
@@ -1,15 +1,40 @@
+import os
 import numpy as np
 import io
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
-from config import COHERE_API_KEY
-import cohere
+from config import DATA_DIR, EMBED_PROVIDER
+from core.providers import make_embed_client, FAKE_EMBED_DIM
+from core.rate_limit import TokenBucket, AdaptiveConcurrency, call_with_backoff
+from core.embedding_cache import EmbeddingCache, content_key
+from core.cache import LRUCache, normalize_query
+from core.metrics import embed_batch_inputs
+from core.tracing import span, traced
 
 # Constants
 MAX_PIXELS = 1568 * 1568  # Cohere image size limit
+# Fake vectors are cached apart from real ones
+EMBED_MODEL = "embed-v4.0" if EMBED_PROVIDER == "cohere" else f"{EMBED_PROVIDER}-{FAKE_EMBED_DIM}"
+# Per-request limits of the embed endpoint
+MAX_BATCH_INPUTS = int(os.getenv('COHERE_MAX_BATCH_INPUTS', 96))
+MAX_BATCH_BYTES = int(os.getenv('COHERE_MAX_BATCH_BYTES', 20 * 1024 * 1024))
+# Provider rate limit and concurrency bounds, shared by every upload in the process
+EMBED_RATE_PER_MIN = float(os.getenv('COHERE_RATE_LIMIT_PER_MIN', 2000))
+EMBED_MAX_CONCURRENCY = int(os.getenv('COHERE_MAX_CONCURRENCY', 8))
+EMBED_MAX_RETRIES = int(os.getenv('COHERE_MAX_RETRIES', 5))
+# Query embedding cache: entries and time-to-live in seconds
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 1024))
+QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', 3600))
 
-# Initialize Cohere client
-co_client = cohere.ClientV2(api_key=COHERE_API_KEY)
+# Initialize Cohere client (or its stand-in, see EMBED_PROVIDER)
+co_client = make_embed_client()
+
+_embed_bucket = TokenBucket(EMBED_RATE_PER_MIN / 60)
+_embed_concurrency = AdaptiveConcurrency(initial=2, maximum=EMBED_MAX_CONCURRENCY)
+_embed_pool = ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY, thread_name_prefix="embed")
+embedding_cache = EmbeddingCache(os.path.join(DATA_DIR, "embedding_cache", EMBED_MODEL))
+query_cache = LRUCache(QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
 
 def resize_image(pil_image):
     """Resize image if too large for embedding API"""
@@ -30,45 +55,191 @@ def base64_from_image(pil_image):
         img_bytes = buffer.getvalue()
     return f"data:image/{img_format.lower()};base64," + base64.b64encode(img_bytes).decode("utf-8")
 
+def _embed_batch(batch, input_type):
+    """One embed call for a batch of (content, content_type) items of a single kind"""
+    embed_batch_inputs.observe(len(batch), kind=batch[0][1])
+    with span("embed_call"):
+        return _embed_call(batch, input_type)
+
+def _embed_call(batch, input_type):
+    if batch[0][1] == "text":
+        response = co_client.embed(
+            model=EMBED_MODEL,
+            input_type=input_type,
+            embedding_types=["float"],
+            texts=[content for content, _ in batch],
+        )
+    else:
+        # Convert to proper multimodal format according to Cohere v2 API
+        response = co_client.embed(
+            model=EMBED_MODEL,
+            input_type=input_type,
+            embedding_types=["float"],
+            inputs=[
+                {"content": [{"type": "image_url", "image_url": {"url": content}}]}
+                for content, _ in batch
+            ],
+        )
+    return np.asarray(response.embeddings.float, dtype="float32")
+
+def _pack_batches(items):
+    """Group item positions into embed calls, texts and images separately, within request limits"""
+    batches = []
+    for kind in ("text", "image"):
+        batch, batch_bytes = [], 0
+        for i, (content, content_type) in enumerate(items):
+            if content is None or content_type != kind:
+                continue
+            size = len(content)
+            if batch and (len(batch) >= MAX_BATCH_INPUTS or batch_bytes + size > MAX_BATCH_BYTES):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(i)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+    return batches
+
+def _embed_uncached(items, input_type):
+    """Embed items through the provider; returns (matrix, embedded mask)"""
+    # Encode images once up front so batches can be sized by payload
+    encoded = []
+    for content, content_type in items:
+        if content_type != "text":
+            try:
+                content = base64_from_image(content)
+            except Exception as e:
+                print(f"Image encoding error: {e}")
+                content = None
+        encoded.append((content, "text" if content_type == "text" else "image"))
+    items = encoded
+    vectors = None
+    ok = np.zeros(len(items), dtype=bool)
+
+    batches = _pack_batches(items)
+    futures = {
+        _embed_pool.submit(
+            traced(call_with_backoff),
+            lambda batch=batch: _embed_batch([items[i] for i in batch], input_type),
+            bucket=_embed_bucket,
+            concurrency=_embed_concurrency,
+            size=len(batch),
+            max_retries=EMBED_MAX_RETRIES,
+        ): batch
+        for batch in batches
+    }
+    for future in as_completed(futures):
+        batch = futures[future]
+        try:
+            embeddings = future.result()
+        except Exception as e:
+            print(f"Embedding failed for {len(batch)} {items[batch[0]][1]} inputs after retries: {e}")
+            continue
+        if vectors is None:
+            vectors = np.zeros((len(items), embeddings.shape[1]), dtype="float32")
+        vectors[batch] = embeddings
+        ok[batch] = True
+
+    if vectors is None:
+        vectors = np.zeros((len(items), 0), dtype="float32")
+    return vectors, ok
+
+def get_document_embeddings(items, input_type="search_document"):
+    """Embed many documents (text or image) in as few API calls as possible.
+
+    ``items`` is a list of ``(content, content_type)`` pairs. Items already in
+    the embedding cache are served from disk; the rest are batched, sent
+    concurrently through the shared rate limiter and retried on throttling or
+    provider errors. Returns a float32 matrix with one row per item and a
+    boolean mask of the rows that were embedded; items whose call still failed
+    are left as zero rows and masked out.
+    """
+    keys = [None] * len(items)
+    if embedding_cache.enabled:
+        keys = [
+            content_key(content, "text" if content_type == "text" else "image", EMBED_MODEL, input_type)
+            for content, content_type in items
+        ]
+    cached = embedding_cache.get_many(keys)
+    missing = np.array([i for i, vector in enumerate(cached) if vector is None], dtype=int)
+
+    fresh_ok = np.zeros(len(missing), dtype=bool)
+    if len(missing):
+        fresh, fresh_ok = _embed_uncached([items[i] for i in missing], input_type)
+    if fresh_ok.any():
+        embedding_cache.put_many([keys[i] for i in missing[fresh_ok]], fresh[fresh_ok])
+
+    # Cached rows are kept even when every uncached batch failed
+    dim = fresh.shape[1] if fresh_ok.any() else next((len(v) for v in cached if v is not None), 0)
+    vectors = np.zeros((len(items), dim), dtype="float32")
+    ok = np.zeros(len(items), dtype=bool)
+    for i, vector in enumerate(cached):
+        if vector is not None:
+            vectors[i] = vector
+            ok[i] = True
+    if fresh_ok.any():
+        vectors[missing[fresh_ok]] = fresh[fresh_ok]
+        ok[missing[fresh_ok]] = True
+    return vectors, ok
+
 def get_document_embedding(content, content_type="text"):
     """Embed document (text or image)"""
-    try:
-        if content_type == "text":
-            response = co_client.embed(
-                model="embed-v4.0",
-                input_type="search_document",
-                embedding_types=["float"],
-                texts=[content],
-            )
-            return np.array(response.embeddings.float[0])
-        else:
-            # Convert to proper multimodal format according to Cohere v2 API
-            api_input_document = {
-                "content": [
-                    {"type": "image_url", "image_url": {"url": base64_from_image(content)}},
-                ]
-            }
-            response = co_client.embed(
-                model="embed-v4.0",
-                input_type="search_document",
-                embedding_types=["float"],
-                inputs=[api_input_document],
-            )
-            return np.array(response.embeddings.float[0])
-    except Exception as e:
-        print(f"Embedding error: {e}")
-        return None
+    vectors, ok = get_document_embeddings([(content, content_type)])
+    return vectors[0] if ok[0] else None
 
 def get_query_embedding(query):
-    """Embed search query"""
+    """Embed search query, reusing the vector of a recent identical query"""
+    key = (EMBED_MODEL, normalize_query(query))
+    vector = query_cache.get(key)
+    if vector is not None:
+        return vector
     try:
-        response = co_client.embed(
-            model="embed-v4.0",
-            input_type="search_query",
-            embedding_types=["float"],
-            texts=[query],
-        )
-        return np.array(response.embeddings.float[0])
+        with span("query_embed"):
+            vectors = call_with_backoff(
+                lambda: _embed_batch([(query, "text")], "search_query"),
+                bucket=_embed_bucket,
+                max_retries=2,
+            )
+        vector = np.array(vectors[0])
+        vector.setflags(write=False)  # shared between requests
+        query_cache.put(key, vector)
+        return vector
     except Exception as e:
         print(f"Query embedding error: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def get_query_embeddings(queries):
+    """Embed many search queries in batched calls; returns (matrix, embedded mask) like get_document_embeddings.
+
+    Recent queries come from the query cache and repeated queries are embedded
+    once.
+    """
+    keys = [(EMBED_MODEL, normalize_query(query)) for query in queries]
+    found = {}
+    missing = {}
+    for query, key in zip(queries, keys):
+        if key in found or key in missing:
+            continue
+        vector = query_cache.get(key)
+        if vector is not None:
+            found[key] = vector
+        else:
+            missing[key] = query
+
+    if missing:
+        with span("query_embed"):
+            fresh, fresh_ok = _embed_uncached([(query, "text") for query in missing.values()], "search_query")
+        for key, vector, ok in zip(missing, fresh, fresh_ok):
+            if ok:
+                vector.setflags(write=False)  # shared between requests
+                query_cache.put(key, vector)
+                found[key] = vector
+
+    dim = next((len(v) for v in found.values()), 0)
+    vectors = np.zeros((len(queries), dim), dtype="float32")
+    ok = np.zeros(len(queries), dtype=bool)
+    for i, key in enumerate(keys):
+        if key in found:
+            vectors[i] = found[key]
+            ok[i] = True
+    return vectors, ok
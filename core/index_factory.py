@@ -0,0 +1,491 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import faiss
+
+# "flat", "ivf_flat", "ivf_pq", "hnsw", or "auto": flat until the index holds
+# INDEX_ANN_THRESHOLD vectors, then INDEX_AUTO_TYPE
+INDEX_TYPE = os.getenv('INDEX_TYPE', 'auto')
+INDEX_AUTO_TYPE = os.getenv('INDEX_AUTO_TYPE', 'hnsw')
+INDEX_ANN_THRESHOLD = int(os.getenv('INDEX_ANN_THRESHOLD', 100_000))
+
+# Build-time parameters
+IVF_NLIST = int(os.getenv('IVF_NLIST', 4096))
+IVF_TRAIN_PER_LIST = int(os.getenv('IVF_TRAIN_PER_LIST', 64))
+IVF_MIN_TRAIN = int(os.getenv('IVF_MIN_TRAIN', 1000))
+IVF_PQ_M = int(os.getenv('IVF_PQ_M', 64))
+HNSW_M = int(os.getenv('HNSW_M', 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv('HNSW_EF_CONSTRUCTION', 200))
+
+# Search-time defaults, overridable per query
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', 16))
+HNSW_EF_SEARCH = int(os.getenv('HNSW_EF_SEARCH', 128))
+
+# Filtered searches over at most this many vectors are exact scans of just
+# those vectors; larger ones search the index with an id selector (which can
+# return fewer than k hits from HNSW when the filter is very selective)
+FILTER_EXACT_MAX = int(os.getenv('FILTER_EXACT_MAX', 4096))
+# Id selectors kept for the filters DocsInfo.select caches
+FILTER_CACHE_SIZE = int(os.getenv('FILTER_CACHE_SIZE', 16))
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# Read snapshots memory-mapped, so processes on one host share a single copy
+# through the page cache: IO_FLAG_MMAP_IFC maps flat, HNSW and IVF storage on
+# FAISS versions that have it; older ones map only IVF inverted lists
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+class LayeredIndex:
+    """A read-only snapshot index plus a small in-memory index of vectors added since.
+
+    Snapshots may be memory-mapped and must never be modified, so this object
+    is immutable too: ``with_added()`` returns a new one, and callers swap the
+    reference while searches in flight keep using the old one.
+    """
+
+    def __init__(self, snapshot, recent=None):
+        self.snapshot = snapshot
+        self.recent = recent if recent is not None else faiss.IndexIDMap2(faiss.IndexFlatL2(snapshot.d))
+
+    @property
+    def d(self):
+        return self.snapshot.d
+
+    @property
+    def ntotal(self):
+        return self.snapshot.ntotal + self.recent.ntotal
+
+    def with_added(self, vectors, ids):
+        recent = faiss.clone_index(self.recent)
+        recent.add_with_ids(vectors, ids)
+        return LayeredIndex(self.snapshot, recent)
+
+    def reconstruct(self, vector_id):
+        try:
+            return self.recent.reconstruct(vector_id)
+        except RuntimeError:
+            return self.snapshot.reconstruct(vector_id)
+
+
+def read_snapshot(path, mmap=True):
+    """A LayeredIndex over the snapshot at ``path``"""
+    return LayeredIndex(faiss.read_index(path, MMAP_FLAGS if mmap else 0))
+
+
+def base_index(index):
+    """The index an IndexIDMap (or a LayeredIndex's snapshot) wraps, or ``index`` itself"""
+    if isinstance(index, LayeredIndex):
+        index = index.snapshot
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def index_type_of(index):
+    if index is None:
+        return None
+    index = base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def _ideal_nlist(ntotal):
+    # Rule of thumb: about 4 * sqrt(n) inverted lists
+    return max(1, min(IVF_NLIST, int(4 * math.sqrt(max(ntotal, 1)))))
+
+
+def target_index_type(ntotal, current=None, configured=INDEX_TYPE):
+    """Index type a corpus of ``ntotal`` vectors should use, given its ``current`` type"""
+    if configured == "auto":
+        index_type = INDEX_AUTO_TYPE if ntotal >= INDEX_ANN_THRESHOLD else "flat"
+        if index_type == "flat" and current not in (None, "flat"):
+            # An ANN index is never demoted again after deletions
+            index_type = current
+    elif configured in INDEX_TYPES:
+        index_type = configured
+    else:
+        raise ValueError(f"Unknown INDEX_TYPE {configured!r}; expected auto or one of {', '.join(INDEX_TYPES)}")
+    # IVF needs enough vectors to train its coarse quantizer
+    if index_type in ("ivf_flat", "ivf_pq") and ntotal < IVF_MIN_TRAIN:
+        return "flat"
+    return index_type
+
+
+def needs_rebuild(index, target):
+    """Whether ``index`` should be rebuilt as ``target`` (or retrained for its current size)"""
+    if isinstance(index, LayeredIndex):
+        index = index.snapshot
+    if not isinstance(index, faiss.IndexIDMap):
+        # Positional index from an older version: rebuild with explicit ids
+        return True
+    current = index_type_of(index)
+    if current != target:
+        return True
+    if current in ("ivf_flat", "ivf_pq"):
+        return _ideal_nlist(index.ntotal) >= 4 * faiss.extract_index_ivf(base_index(index)).nlist
+    return False
+
+
+def _pq_subquantizers(dim, wanted):
+    """Largest divisor of dim that is <= wanted"""
+    return next(m for m in range(min(wanted, dim), 0, -1) if dim % m == 0)
+
+
+def new_index(dim, index_type, ntotal=0):
+    """Empty index of ``index_type`` sized for about ``ntotal`` vectors (IVF types still need training)"""
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        return index
+    nlist = _ideal_nlist(ntotal)
+    quantizer = faiss.IndexFlatL2(dim)
+    if index_type == "ivf_flat":
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+    elif index_type == "ivf_pq":
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_subquantizers(dim, IVF_PQ_M), 8)
+    else:
+        raise ValueError(f"Unknown index type {index_type!r}")
+    index.nprobe = min(IVF_NPROBE, nlist)
+    return index
+
+
+def _trained_copy(index):
+    """Empty IVF index with the coarse centroids (and PQ codebooks) of ``index``.
+
+    Built field by field: a memory-mapped snapshot cannot be cloned and reset.
+    """
+    ivf = base_index(index)
+    quantizer = faiss.IndexFlatL2(ivf.d)
+    quantizer.add(ivf.quantizer.reconstruct_n(0, ivf.nlist))
+    if isinstance(ivf, faiss.IndexIVFPQ):
+        empty = faiss.IndexIVFPQ(quantizer, ivf.d, ivf.nlist, ivf.pq.M, ivf.pq.nbits)
+        empty.pq = ivf.pq
+        empty.is_trained = True
+        empty.precompute_table()
+    else:
+        empty = faiss.IndexIVFFlat(quantizer, ivf.d, ivf.nlist)
+        empty.is_trained = True
+    empty.nprobe = ivf.nprobe
+    return empty
+
+
+def build_index(vectors, index_type, ids=None):
+    """Index of ``index_type`` over ``vectors``, labelled with ``ids`` (default 0..n-1).
+
+    The result is an IndexIDMap2, so vectors keep their ids across rebuilds and
+    can be looked up with ``reconstruct(id)``. IVF types are trained on a
+    random sample.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    ids = np.arange(len(vectors), dtype="int64") if ids is None else np.asarray(ids, dtype="int64")
+    index = new_index(vectors.shape[1], index_type, len(vectors))
+    if not index.is_trained:
+        ivf = faiss.extract_index_ivf(index)
+        sample_size = min(len(vectors), max(ivf.nlist * IVF_TRAIN_PER_LIST, 1))
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), sample_size, replace=False)]
+        index.train(sample)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        # Keeps reconstruct() available for later rebuilds and recall reports
+        faiss.extract_index_ivf(index).make_direct_map()
+    index = faiss.IndexIDMap2(index)
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def _ivf_without(index, drop_ids):
+    """Copy of an IVF IndexIDMap2 without ``drop_ids``: stored codes are copied list by list, not re-encoded"""
+    ivf = base_index(index)
+    external = index_ids(index)
+    keep = ~np.isin(external, drop_ids)
+    # Internal ids are storage positions; the kept vectors are renumbered 0..n-1
+    position = np.cumsum(keep) - 1
+    copy = _trained_copy(index)
+    compacted = faiss.IndexIDMap2(copy)
+    invlists = ivf.invlists
+    for list_no in range(ivf.nlist):
+        size = invlists.list_size(list_no)
+        if not size:
+            continue
+        ids_ptr, codes_ptr = invlists.get_ids(list_no), invlists.get_codes(list_no)
+        internal = faiss.rev_swig_ptr(ids_ptr, size).copy()
+        codes = faiss.rev_swig_ptr(codes_ptr, size * invlists.code_size).copy().reshape(size, -1)
+        invlists.release_ids(list_no, ids_ptr)
+        invlists.release_codes(list_no, codes_ptr)
+        kept = keep[internal]
+        if kept.any():
+            # Held in locals: swig_ptr does not keep its array alive
+            kept_ids = np.ascontiguousarray(position[internal[kept]], dtype="int64")
+            kept_codes = np.ascontiguousarray(codes[kept])
+            copy.invlists.add_entries(list_no, len(kept_ids), faiss.swig_ptr(kept_ids), faiss.swig_ptr(kept_codes))
+    copy.ntotal = int(keep.sum())
+    copy.make_direct_map()
+    faiss.copy_array_to_vector(external[keep], compacted.id_map)
+    compacted.ntotal = copy.ntotal
+    compacted.construct_rev_map()
+    return compacted
+
+
+def compact_index(index, drop_ids):
+    """``index`` (an IndexIDMap2 or LayeredIndex) rebuilt without ``drop_ids``, keeping its type.
+
+    IVF indexes keep their training and stored codes, so compacting an IVF-PQ
+    index does not retrain on (and re-encode) vectors decoded from PQ codes,
+    which loses recall on every compaction. Other types store vectors exactly
+    and are rebuilt from them.
+    """
+    drop_ids = np.fromiter(drop_ids, dtype="int64", count=len(drop_ids))
+    index_type = index_type_of(index)
+    if index_type not in ("ivf_flat", "ivf_pq"):
+        ids, vectors = all_vectors(index)
+        keep = ~np.isin(ids, drop_ids)
+        return build_index(vectors[keep], index_type, ids[keep])
+    if not isinstance(index, LayeredIndex):
+        return _ivf_without(index, drop_ids)
+    compacted = _ivf_without(index.snapshot, drop_ids)
+    # The recent layer is a flat index, so its vectors are exact
+    ids, vectors = all_vectors(index.recent)
+    keep = ~np.isin(ids, drop_ids)
+    if keep.any():
+        compacted.add_with_ids(vectors[keep], ids[keep])
+    return compacted
+
+
+def has_id(index, vector_id):
+    try:
+        index.reconstruct(int(vector_id))
+        return True
+    except RuntimeError:
+        return False
+
+
+def index_ids(index):
+    """Vector ids in storage order"""
+    if isinstance(index, LayeredIndex):
+        return np.concatenate([index_ids(index.snapshot), index_ids(index.recent)])
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map).astype("int64")
+    return np.arange(index.ntotal, dtype="int64")
+
+
+def _ensure_direct_map(index):
+    """reconstruct() support for IVF indexes (set at build time; snapshots are read-only)"""
+    if index_type_of(index) in ("ivf_flat", "ivf_pq"):
+        ivf = faiss.extract_index_ivf(base_index(index))
+        if ivf.direct_map.no():
+            ivf.make_direct_map()
+
+
+def _vector_chunks(index, chunk=50_000):
+    """(ids, vectors) blocks in storage order (vectors approximate for PQ-compressed indexes)"""
+    if isinstance(index, LayeredIndex):
+        yield from _vector_chunks(index.snapshot, chunk)
+        yield from _vector_chunks(index.recent, chunk)
+        return
+    base = base_index(index)
+    _ensure_direct_map(index)
+    ids = index_ids(index)
+    for start in range(0, index.ntotal, chunk):
+        count = min(chunk, index.ntotal - start)
+        yield ids[start:start + count], base.reconstruct_n(start, count)
+
+
+def all_vectors(index):
+    """All stored ``(ids, vectors)``"""
+    blocks = list(_vector_chunks(index))
+    if not blocks:
+        return np.zeros(0, dtype="int64"), np.zeros((0, index.d), dtype="float32")
+    return np.concatenate([ids for ids, _ in blocks]), np.vstack([vectors for _, vectors in blocks])
+
+
+def search_params(index, nprobe=None, ef_search=None, selector=None):
+    """Per-query search parameters, so concurrent requests do not mutate the shared index"""
+    index_type = index_type_of(index)
+    params = {"sel": selector} if selector is not None else {}
+    if index_type in ("ivf_flat", "ivf_pq"):
+        if nprobe:
+            params["nprobe"] = nprobe
+        return faiss.SearchParametersIVF(**params) if params else None
+    if index_type == "hnsw":
+        if ef_search:
+            params["efSearch"] = ef_search
+        return faiss.SearchParametersHNSW(**params) if params else None
+    return faiss.SearchParameters(**params) if params else None
+
+
+_exclusion = (None, None)
+_selectors = OrderedDict()
+_selectors_lock = threading.Lock()
+
+
+def exclusion_selector(exclude_ids):
+    """Selector of the ids not in ``exclude_ids``, built once per set (tombstone sets are replaced, never mutated)"""
+    global _exclusion
+    cached_ids, selector = _exclusion
+    if cached_ids is not exclude_ids:
+        ids = np.fromiter(exclude_ids, dtype="int64", count=len(exclude_ids))
+        # IDSelectorNot keeps the batch selector alive; the batch copies the ids
+        selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids)))
+        _exclusion = (exclude_ids, selector)
+    return selector
+
+
+def _batch_selector(ids):
+    """IDSelectorBatch over ``ids``; kept for read-only arrays, which DocsInfo.select returns and reuses"""
+    if ids.flags.writeable:
+        # (n, pointer) form: older FAISS releases do not take an array; the
+        # selector copies the ids, so ``ids`` need not outlive it
+        return faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+    with _selectors_lock:
+        cached = _selectors.get(id(ids))
+        if cached is not None and cached[0] is ids:
+            _selectors.move_to_end(id(ids))
+            return cached[1]
+    selector = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+    with _selectors_lock:
+        # Keyed by identity; holding the array keeps its id from being reused
+        _selectors[id(ids)] = (ids, selector)
+        while len(_selectors) > FILTER_CACHE_SIZE:
+            _selectors.popitem(last=False)
+    return selector
+
+
+def _reconstruct_present(index, ids):
+    """``(ids, vectors)`` for the ``ids`` stored in ``index``"""
+    try:
+        return ids, index.reconstruct_batch(ids)
+    except RuntimeError:
+        # Some were added after the caller took this index (a concurrent upload)
+        ids = np.array([i for i in ids if has_id(index, int(i))], dtype="int64")
+        return ids, index.reconstruct_batch(ids) if len(ids) else np.zeros((0, index.d), dtype="float32")
+
+
+def reconstruct_many(index, ids):
+    """``(ids, vectors)`` for the vector ids in ``ids`` that ``index`` stores (approximate for PQ indexes)"""
+    ids = np.asarray(ids, dtype="int64")
+    if isinstance(index, LayeredIndex):
+        in_recent = np.isin(ids, index_ids(index.recent))
+        snapshot_ids, snapshot_vectors = _reconstruct_present(index.snapshot, ids[~in_recent])
+        recent_ids, recent_vectors = _reconstruct_present(index.recent, ids[in_recent])
+        return np.concatenate([snapshot_ids, recent_ids]), np.vstack([snapshot_vectors, recent_vectors])
+    return _reconstruct_present(index, ids)
+
+
+def _search_subset(index, queries, k, ids):
+    """Exact top-k over the stored vectors of ``ids`` only"""
+    ids, vectors = reconstruct_many(index, ids)
+    D = np.full((len(queries), k), np.inf, dtype="float32")
+    I = np.full((len(queries), k), -1, dtype="int64")
+    if len(ids):
+        flat = faiss.IndexFlatL2(index.d)
+        flat.add(np.ascontiguousarray(vectors, dtype="float32"))
+        d, i = flat.search(queries, min(k, len(ids)))
+        D[:, :d.shape[1]] = d
+        I[:, :i.shape[1]] = np.where(i >= 0, ids[np.maximum(i, 0)], -1)
+    return D, I
+
+
+def search(index, queries, k, nprobe=None, ef_search=None, ids=None, selector=None, exclude_ids=None):
+    """Top-k ``(distances, ids)`` for a query matrix.
+
+    ``ids`` restricts the search to those vector ids; otherwise ids in
+    ``exclude_ids`` (e.g. tombstones) are skipped, so they take none of the k.
+    """
+    if ids is None and exclude_ids:
+        selector = exclusion_selector(exclude_ids)
+    if ids is not None:
+        ids = np.asarray(ids, dtype="int64")
+        if len(ids) <= FILTER_EXACT_MAX:
+            return _search_subset(index, queries, k, ids)
+        selector = _batch_selector(ids)
+    if isinstance(index, LayeredIndex):
+        if index.snapshot.ntotal:
+            D, I = search(index.snapshot, queries, k, nprobe, ef_search, selector=selector)
+        else:
+            D, I = None, None
+        if not index.recent.ntotal:
+            return D, I
+        params = search_params(index.recent, selector=selector)
+        if params is None:
+            d, i = index.recent.search(queries, min(k, index.recent.ntotal))
+        else:
+            d, i = index.recent.search(queries, min(k, index.recent.ntotal), params=params)
+        if D is None:
+            return d, i
+        # Merge the two top-k lists by distance; missing hits (-1) sort last
+        D = np.hstack([np.where(I >= 0, D, np.inf), np.where(i >= 0, d, np.inf)])
+        I = np.hstack([I, i])
+        order = np.argsort(D, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+    params = search_params(index, nprobe, ef_search, selector)
+    if params is None:
+        return index.search(queries, k)
+    return index.search(queries, k, params=params)
+
+
+def _exact_neighbors(index, queries, k):
+    """Brute-force top-k ids over the vectors stored in ``index``, one chunk at a time"""
+    best_d = np.full((len(queries), k), np.inf, dtype="float32")
+    best_i = np.full((len(queries), k), -1, dtype="int64")
+    for ids, block in _vector_chunks(index):
+        flat = faiss.IndexFlatL2(block.shape[1])
+        flat.add(block)
+        d, i = flat.search(queries, min(k, len(block)))
+        d = np.hstack([best_d, d])
+        i = np.hstack([best_i, np.where(i >= 0, ids[np.maximum(i, 0)], -1)])
+        order = np.argsort(d, axis=1)[:, :k]
+        best_d = np.take_along_axis(d, order, axis=1)
+        best_i = np.take_along_axis(i, order, axis=1)
+    return best_i
+
+
+def recall_report(index, k=10, sample_size=100, nprobes=(1, 4, 16, 64, 256), ef_searches=(16, 32, 64, 128, 256)):
+    """Recall@k and per-query latency of ``index`` at several search settings, against exact search.
+
+    Queries are a random sample of the indexed vectors; ground truth is a
+    brute-force scan over the stored vectors.
+    """
+    index_type = index_type_of(index)
+    if index is None or index.ntotal == 0:
+        return {"index_type": index_type, "ntotal": 0, "results": []}
+    base = base_index(index)
+    _ensure_direct_map(index)
+
+    ids = index_ids(index)
+    sample = np.random.default_rng(0).choice(ids, min(sample_size, len(ids)), replace=False)
+    queries = np.vstack([index.reconstruct(int(i)) for i in sample]).astype("float32")
+    k = min(k, index.ntotal)
+    truth = _exact_neighbors(index, queries, k)
+
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist = faiss.extract_index_ivf(base).nlist
+        settings = [{"nprobe": n} for n in nprobes if n <= nlist]
+    elif index_type == "hnsw":
+        settings = [{"ef_search": ef} for ef in ef_searches]
+    else:
+        settings = [{}]
+
+    results = []
+    for setting in settings:
+        started = time.perf_counter()
+        _, found = search(index, queries, k, **setting)
+        elapsed = time.perf_counter() - started
+        hits = sum(len(set(row_found) & set(row_truth)) for row_found, row_truth in zip(found, truth))
+        results.append({
+            **setting,
+            "recall_at_k": hits / truth.size,
+            "latency_ms_per_query": 1000 * elapsed / len(queries),
+        })
+    return {"index_type": index_type, "ntotal": int(index.ntotal), "k": k, "queries": len(queries), "results": results}
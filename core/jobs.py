@@ -0,0 +1,228 @@
+import os
+import time
+import uuid
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from core.document_utils import DATA_DIR, index_pdf
+from core.tracing import Trace, activate, span, maybe_profile
+
+# Ingestion jobs run concurrently on INGEST_WORKERS threads; page rendering
+# goes to a pool of RASTER_PROCESSES processes (0 renders in the job thread).
+# Embedding calls already run on the embeddings module's I/O thread pool.
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))
+RASTER_PROCESSES = int(os.getenv('RASTER_PROCESSES', min(4, os.cpu_count() or 1)))
+# Seconds a finished job stays queryable
+JOB_RETENTION = float(os.getenv('JOB_RETENTION', 3600))
+# Seconds between saves of a running job's progress to the metadata database,
+# where other workers read it; a cancel made on another worker waits as long
+JOB_SAVE_INTERVAL = float(os.getenv('JOB_SAVE_INTERVAL', 1.0))
+UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """One upload of one or more PDFs and its per-file, per-page progress"""
+
+    def __init__(self, job_id, files):
+        self.id = job_id
+        self.status = "queued"
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.files = [{"filename": filename, "path": path, "status": "queued"} for filename, path in files]
+        # Spans of the processing, from when a worker picks the job up
+        self.trace = None
+        self.profile = None
+        self._cancel = threading.Event()
+        self._saved_at = 0.0
+
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed", "cancelled")
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "files": [{k: v for k, v in f.items() if k != "path"} for f in self.files],
+            "timings": self.trace.timings() if self.trace is not None else None,
+            "profile": self.profile,
+        }
+
+
+class JobQueue:
+    """Runs ingestion jobs in the background so uploads return immediately.
+
+    Each file is rendered, embedded and appended to ``index_store`` on its
+    own, so the pages of finished files become searchable while later files
+    are still being processed. Job states are saved to the index store's
+    metadata database, so any process sharing it can report or cancel a job.
+    """
+
+    def __init__(self, index_store, embed_fn, workers=INGEST_WORKERS, raster_processes=RASTER_PROCESSES):
+        self.index_store = index_store
+        self.metadata = index_store.metadata
+        self.embed_fn = embed_fn
+        self.raster_processes = raster_processes
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self._raster_pool = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _render_executor(self):
+        if self.raster_processes <= 0:
+            return None
+        with self._lock:
+            if self._raster_pool is None:
+                # spawn, not fork: the server process is multi-threaded
+                self._raster_pool = ProcessPoolExecutor(
+                    max_workers=self.raster_processes, mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._raster_pool
+
+    def submit(self, uploads):
+        """Queue ``(filename, file-like)`` uploads; they are copied to UPLOAD_DIR before this returns"""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(UPLOAD_DIR, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        files = []
+        with span("upload_spool"):
+            for number, (filename, stream) in enumerate(uploads):
+                path = os.path.join(job_dir, f"{number}.pdf")
+                with open(path, "wb") as f:
+                    shutil.copyfileobj(stream, f)
+                files.append((filename, path))
+
+        job = Job(job_id, files)
+        self._save(job, force=True)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._workers.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        """State of a job run by this or another process (see Job.to_dict), or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self.metadata.load_job(job_id)
+
+    def cancel(self, job_id):
+        """Stop a job at its next page; files already indexed stay indexed. Returns its state or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            # Run by another process, which sees the request at its next save
+            return self.metadata.cancel_job(job_id)
+        if not job.finished:
+            job._cancel.set()
+        return job.to_dict()
+
+    def _save(self, job, force=False):
+        """Save the job's state for other processes, at most every JOB_SAVE_INTERVAL unless forced.
+
+        Also picks up a cancellation requested through another process.
+        """
+        now = time.time()
+        if not force and now - job._saved_at < JOB_SAVE_INTERVAL:
+            return
+        job._saved_at = now
+        try:
+            if self.metadata.save_job(job.id, job.to_dict(), job.finished_at if job.finished else None):
+                job._cancel.set()
+        except Exception as e:
+            print(f"Could not save the state of ingestion job {job.id}: {e}")
+
+    def _run(self, job):
+        job.trace = Trace(f"job {job.id}")
+        with activate(job.trace):
+            profiler = maybe_profile(job.trace)
+            try:
+                self._run_job(job)
+            finally:
+                job.trace.finish()
+                if profiler is not None:
+                    job.profile = os.path.basename(profiler.stop())
+                # Final state, with the job's timings and profile
+                self._save(job, force=True)
+
+    def _run_job(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        self._save(job, force=True)
+        try:
+            for file in job.files:
+                if job._cancel.is_set():
+                    file["status"] = "cancelled"
+                    continue
+                self._run_file(job, file)
+                self._save(job, force=True)
+            if job._cancel.is_set():
+                job.status = "cancelled"
+            elif all(f["status"] == "failed" for f in job.files):
+                job.status = "failed"
+                job.error = "No file could be processed"
+            else:
+                job.status = "completed"
+        except Exception as e:
+            print(f"Ingestion job {job.id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            shutil.rmtree(os.path.join(UPLOAD_DIR, job.id), ignore_errors=True)
+
+    def _run_file(self, job, file):
+        file["status"] = "running"
+
+        def progress(summary):
+            file.update(summary)
+            self._save(job)
+            job.check_cancelled()
+
+        try:
+            vectors, entries, summary = index_pdf(
+                file["path"], file["filename"], self.embed_fn,
+                executor=self._render_executor(), progress=progress,
+            )
+            file.update(summary)
+            if vectors is not None:
+                with span("index_add"):
+                    self.index_store.add(vectors, entries)
+            file["status"] = "completed"
+        except JobCancelled:
+            file["status"] = "cancelled"
+        except Exception as e:
+            print(f"Error processing {file['filename']} in job {job.id}: {e}")
+            file["status"] = "failed"
+            file["error"] = str(e)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION
+        with self._lock:
+            for job_id in [i for i, job in self._jobs.items() if job.finished and job.finished_at < cutoff]:
+                del self._jobs[job_id]
+        self.metadata.prune_jobs(cutoff)
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            job._cancel.set()
+        self._workers.shutdown(wait=True)
+        if self._raster_pool is not None:
+            self._raster_pool.shutdown()
@@ -0,0 +1,323 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Columns loaded eagerly into docs_info; "content" is read on demand and any
+# other keys round-trip through the JSON "extra" column
+EAGER_FIELDS = ("doc_id", "source", "content_type", "page", "page_end", "preview")
+
+# Filtered-search id sets kept per filter until the entries change
+FILTER_CACHE_SIZE = int(os.getenv('FILTER_CACHE_SIZE', 16))
+
+# Query terms as FTS5's default (unicode61) tokenizer splits them
+_TERM = re.compile(r"[^\W_]+")
+
+
+def _prefix_range(prefix):
+    """Bounds of the strings starting with ``prefix``, for a range scan"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class MetadataStore:
+    """docs_info rows in SQLite, keyed by vector_id.
+
+    Writes are appended in one transaction per upload instead of rewriting the
+    whole collection, and the (potentially large) extracted text stays on disk
+    until a search hit needs it. The text is also indexed for BM25 keyword
+    search in an FTS5 table that reads it from ``docs`` rather than storing a
+    second copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "vector_id INTEGER PRIMARY KEY, doc_id TEXT NOT NULL, source TEXT, content_type TEXT, "
+            "page INTEGER, page_end INTEGER, preview TEXT, extra TEXT, content TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS docs_doc_id ON docs (doc_id)")
+        # Ingestion job states, so every worker sharing the database can report and cancel them
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, state TEXT NOT NULL, finished_at REAL, cancel INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Write-locked, so processes starting together create the table once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'docs_fts'").fetchone():
+                conn.execute(
+                    "CREATE VIRTUAL TABLE docs_fts USING fts5(content, content='docs', content_rowid='vector_id')"
+                )
+                # Index the text of databases written before keyword search
+                conn.execute("INSERT INTO docs_fts (docs_fts) VALUES ('rebuild')")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, entries):
+        """Insert (or replace) entries; each must carry its ``vector_id``"""
+        rows = []
+        for entry in entries:
+            extra = {k: v for k, v in entry.items() if k not in EAGER_FIELDS + ("vector_id", "content")}
+            rows.append(
+                (entry["vector_id"],)
+                + tuple(entry.get(field) for field in EAGER_FIELDS)
+                + (json.dumps(extra) if extra else None, entry.get("content"))
+            )
+        with self._conn() as conn:
+            # Rows left behind by a crashed upload are replaced, so unindex their text first
+            self._unindex_text(conn, [row[0] for row in rows])
+            conn.executemany(
+                "INSERT OR REPLACE INTO docs (vector_id, doc_id, source, content_type, page, page_end, preview, extra, content) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.executemany(
+                "INSERT INTO docs_fts (rowid, content) VALUES (?, ?)",
+                [(row[0], row[-1]) for row in rows if row[-1] is not None],
+            )
+
+    def _unindex_text(self, conn, vector_ids):
+        # External-content FTS5 removes a row's terms given its current text
+        conn.executemany(
+            "INSERT INTO docs_fts (docs_fts, rowid, content) "
+            "SELECT 'delete', vector_id, content FROM docs WHERE vector_id = ? AND content IS NOT NULL",
+            [(int(i),) for i in vector_ids],
+        )
+
+    def load(self, start=0, stop=None):
+        """Entries with start <= vector_id < stop, without their content, in vector_id order"""
+        query = f"SELECT vector_id, {', '.join(EAGER_FIELDS)}, extra FROM docs WHERE vector_id >= ?"
+        params = [start]
+        if stop is not None:
+            query += " AND vector_id < ?"
+            params.append(stop)
+        entries = []
+        for row in self._conn().execute(query + " ORDER BY vector_id", params):
+            entry = {"vector_id": row[0]}
+            for field, value in zip(EAGER_FIELDS, row[1:-1]):
+                if value is not None:
+                    entry[field] = value
+            if row[-1]:
+                entry.update(json.loads(row[-1]))
+            entries.append(entry)
+        return entries
+
+    def content(self, vector_id):
+        row = self._conn().execute("SELECT content FROM docs WHERE vector_id = ?", (vector_id,)).fetchone()
+        return row[0] if row else None
+
+    def contents(self, vector_ids):
+        """Text of several entries in one query, as a dict keyed by vector_id"""
+        vector_ids = [int(i) for i in vector_ids]
+        if not vector_ids:
+            return {}
+        rows = self._conn().execute(
+            f"SELECT vector_id, content FROM docs WHERE vector_id IN ({', '.join('?' * len(vector_ids))})",
+            vector_ids,
+        )
+        return dict(rows.fetchall())
+
+    def find(self, doc_id_prefix):
+        """vector_ids of entries whose doc_id starts with ``doc_id_prefix`` (a range scan on the doc_id index)"""
+        if not doc_id_prefix:
+            return []
+        rows = self._conn().execute(
+            "SELECT vector_id FROM docs WHERE doc_id >= ? AND doc_id < ? ORDER BY vector_id",
+            _prefix_range(doc_id_prefix),
+        )
+        return [row[0] for row in rows]
+
+    def search_text(self, query, limit, content_type=None, source=None, doc_id_prefix=None):
+        """BM25 keyword search over entry text; ``(vector_id, score)`` pairs, best (highest score) first.
+
+        ``content_type``, ``source`` and ``doc_id_prefix`` restrict the search
+        to matching entries.
+        """
+        terms = list(dict.fromkeys(term.lower() for term in _TERM.findall(query)))
+        if not terms or limit <= 0:
+            return []
+        # Any term may match; BM25 ranks entries matching more (and rarer) terms first
+        expression = " OR ".join(f'"{term}"' for term in terms)
+        sql = "SELECT docs_fts.rowid, bm25(docs_fts) FROM docs_fts"
+        where = ["docs_fts MATCH ?"]
+        params = [expression]
+        if content_type or source or doc_id_prefix:
+            sql += " JOIN docs ON docs.vector_id = docs_fts.rowid"
+        if content_type:
+            where.append("docs.content_type = ?")
+            params.append(content_type)
+        if source:
+            where.append("docs.source = ?")
+            params.append(source)
+        if doc_id_prefix:
+            where.append("docs.doc_id >= ? AND docs.doc_id < ?")
+            params.extend(_prefix_range(doc_id_prefix))
+        rows = self._conn().execute(
+            f"{sql} WHERE {' AND '.join(where)} ORDER BY bm25(docs_fts) LIMIT ?", params + [limit],
+        )
+        return [(row[0], -row[1]) for row in rows]
+
+    def delete(self, vector_ids):
+        with self._conn() as conn:
+            self._unindex_text(conn, vector_ids)
+            conn.executemany("DELETE FROM docs WHERE vector_id = ?", [(int(i),) for i in vector_ids])
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def clear(self):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO docs_fts (docs_fts) VALUES ('delete-all')")
+            conn.execute("DELETE FROM docs")
+
+    def save_job(self, job_id, state, finished_at=None):
+        """Store a job's state (a JSON-serializable dict); returns whether its cancellation was requested"""
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO jobs (job_id, state, finished_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (job_id) DO UPDATE SET state = excluded.state, finished_at = excluded.finished_at",
+                (job_id, json.dumps(state), finished_at),
+            )
+            return bool(conn.execute("SELECT cancel FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0])
+
+    def load_job(self, job_id):
+        row = self._conn().execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def cancel_job(self, job_id):
+        """Ask the worker running an unfinished job to cancel it; returns the job's state or None"""
+        with self._conn() as conn:
+            conn.execute("UPDATE jobs SET cancel = 1 WHERE job_id = ? AND finished_at IS NULL", (job_id,))
+        return self.load_job(job_id)
+
+    def prune_jobs(self, finished_before):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM jobs WHERE finished_at < ?", (finished_before,))
+
+
+class DocsInfo:
+    """docs_info entries without their text, keyed by vector_id.
+
+    Iterates over the entries like a list; ``get()`` maps a search hit back to
+    its entry and ``content()`` reads the text from the metadata store.
+    """
+
+    def __init__(self, entries=(), metadata=None):
+        self._entries = {}
+        # vector_ids by content_type and by source, for filtered searches
+        self._by_field = {"content_type": {}, "source": {}}
+        # select() results by filter, valid while _changes is unchanged
+        self._selections = OrderedDict()
+        self._changes = 0
+        self._lock = threading.Lock()
+        self.metadata = metadata
+        self.extend(entries)
+
+    def __iter__(self):
+        # Over a copy: uploads and deletes on other threads change the entries meanwhile
+        with self._lock:
+            return iter(list(self._entries.values()))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, vector_id):
+        return self._entries.get(int(vector_id))
+
+    def extend(self, entries):
+        with self._lock:
+            self._changes += 1
+            for entry in entries:
+                self._entries[entry["vector_id"]] = entry
+                for field, ids in self._by_field.items():
+                    ids.setdefault(entry.get(field), set()).add(entry["vector_id"])
+
+    def remove(self, vector_ids):
+        """Drop entries by vector_id; returns the ones that were present"""
+        with self._lock:
+            self._changes += 1
+            removed = [entry for entry in (self._entries.pop(int(i), None) for i in vector_ids) if entry is not None]
+            for entry in removed:
+                for field, ids in self._by_field.items():
+                    ids.get(entry.get(field), set()).discard(entry["vector_id"])
+        return removed
+
+    def counts(self, field="content_type"):
+        """Number of entries per value of ``field`` ("content_type" or "source")"""
+        with self._lock:
+            return {value: len(ids) for value, ids in self._by_field[field].items() if ids}
+
+    def select(self, content_type=None, source=None, doc_id_prefix=None):
+        """Sorted vector_ids of the entries matching every given filter, or None when no filter is given.
+
+        The (read-only) array is cached per filter until the entries change,
+        so repeated filtered searches neither rebuild nor re-sort it.
+        """
+        key = (content_type or None, source or None, doc_id_prefix or None)
+        if key == (None, None, None):
+            return None
+        with self._lock:
+            changes = self._changes
+            cached = self._selections.get(key)
+            if cached is not None and cached[0] == changes:
+                self._selections.move_to_end(key)
+                return cached[1]
+        prefixed = None
+        if doc_id_prefix and self.metadata is not None:
+            prefixed = self.metadata.find(doc_id_prefix)
+        selected = None
+        with self._lock:
+            for field, value in (("content_type", content_type), ("source", source)):
+                if value:
+                    ids = self._by_field[field].get(value, set())
+                    selected = set(ids) if selected is None else selected & ids
+            if doc_id_prefix:
+                if prefixed is None:
+                    prefixed = [i for i, entry in self._entries.items() if entry["doc_id"].startswith(doc_id_prefix)]
+                # Rows of vectors not synced yet (or being deleted) are not searchable
+                ids = {i for i in prefixed if i in self._entries}
+                selected = ids if selected is None else selected & ids
+        ids = np.fromiter(sorted(selected), dtype="int64", count=len(selected))
+        ids.flags.writeable = False
+        with self._lock:
+            # Not cached when the entries changed while it was computed
+            if changes == self._changes:
+                self._selections[key] = (changes, ids)
+                while len(self._selections) > FILTER_CACHE_SIZE:
+                    self._selections.popitem(last=False)
+        return ids
+
+    def search_text(self, query, limit, **filters):
+        """Keyword (BM25) hits for ``query`` from the metadata store; ``(vector_id, score)`` pairs"""
+        if self.metadata is None:
+            return []
+        return self.metadata.search_text(query, limit, **filters)
+
+    def contents(self, doc_infos):
+        """content() of several entries, reading the stored ones in one query"""
+        stored = [d["vector_id"] for d in doc_infos if "content" not in d and "vector_id" in d]
+        texts = self.metadata.contents(stored) if self.metadata is not None and stored else {}
+        return [d["content"] if "content" in d else texts.get(d.get("vector_id")) for d in doc_infos]
+
+    def content(self, doc_info):
+        if "content" in doc_info:
+            return doc_info["content"]
+        if self.metadata is not None and "vector_id" in doc_info:
+            return self.metadata.content(doc_info["vector_id"])
+        return None
@@ -0,0 +1,179 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds: stage latencies in seconds, batch sizes in inputs
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 96, 128)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the ``with`` block, also when it raises"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _labels(self.labelnames, key, [("le", _number(bound))])
+                samples.append(f"{self.name}_bucket{le} {cumulative}")
+            samples.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            samples.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return samples
+
+
+class Gauge(Metric):
+    """A value read when metrics are collected: ``fn()`` returns a number, or a dict of label tuples to numbers.
+
+    ``type="counter"`` exposes a running total kept elsewhere (e.g. a cache's
+    hit count) as a counter.
+    """
+
+    def __init__(self, name, help, fn, labelnames=(), type="gauge"):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self.type = type
+
+    def _samples(self):
+        try:
+            values = self.fn()
+        except Exception as e:
+            print(f"Metric {self.name} failed: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+                for key, value in sorted(values.items()) if value is not None]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add ``metric``; a metric registered again under the same name replaces the old one"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Pipeline metrics, recorded by the modules doing the work. Per process: with
+# several uvicorn workers each one reports its own.
+stage_seconds = registry.register(Histogram(
+    "rag_stage_duration_seconds",
+    "Duration of pipeline stages (pdf_render and text_extract per page, embed_call per provider call, ...)",
+    ("stage",),
+))
+embed_batch_inputs = registry.register(Histogram(
+    "rag_embed_batch_inputs", "Inputs per embedding call", ("kind",), buckets=SIZE_BUCKETS,
+))
+provider_errors = registry.register(Counter(
+    "rag_provider_errors_total", "Failed embedding and LLM provider calls, by HTTP status", ("api", "status"),
+))
+provider_retries = registry.register(Counter(
+    "rag_provider_retries_total", "Provider calls retried after a retryable error", ("api",),
+))
+
+
+def cache_gauges(caches):
+    """Hit, miss, eviction and size metrics for ``{name: cache}``, read from each cache's stats()"""
+    def stat(field):
+        return lambda: {(name,): cache.stats()[field] for name, cache in caches.items()}
+
+    registry.register(Gauge("rag_cache_hits_total", "Cache hits", stat("hits"), ("cache",), type="counter"))
+    registry.register(Gauge("rag_cache_misses_total", "Cache misses", stat("misses"), ("cache",), type="counter"))
+    registry.register(Gauge("rag_cache_evictions_total", "Cache evictions", stat("evictions"), ("cache",),
+                            type="counter"))
+    registry.register(Gauge("rag_cache_hit_ratio", "Cache hits per lookup since start", stat("hit_ratio"), ("cache",)))
+    registry.register(Gauge("rag_cache_entries", "Entries held by each cache", stat("entries"), ("cache",)))
@@ -0,0 +1,74 @@
+import os
+from PIL import Image, features
+from core.cache import LRUCache
+from core.tracing import span
+
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+PREVIEW_DIR = os.path.join(DATA_DIR, "previews")
+
+# Two stored tiers per page instead of a full-resolution PNG: a thumbnail for
+# UI and API listings, and a copy at the LLM's input size (matches
+# CONTEXT_IMAGE_MAX_SIDE, one 768x768 Gemini tile)
+PREVIEW_FORMAT = os.getenv('PREVIEW_FORMAT', 'WEBP' if features.check('webp') else 'JPEG').upper()
+PREVIEW_THUMB_SIDE = int(os.getenv('PREVIEW_THUMB_SIDE', 320))
+PREVIEW_THUMB_QUALITY = int(os.getenv('PREVIEW_THUMB_QUALITY', 70))
+PREVIEW_LLM_SIDE = int(os.getenv('PREVIEW_LLM_SIDE', 768))
+PREVIEW_LLM_QUALITY = int(os.getenv('PREVIEW_LLM_QUALITY', 85))
+
+# Decoded images kept in memory, keyed by (doc_id, tier); an LLM-tier page is
+# about 1.7 MB decoded
+IMAGE_CACHE_SIZE = int(os.getenv('IMAGE_CACHE_SIZE', 128))
+
+_EXTENSIONS = {"WEBP": ".webp", "JPEG": ".jpg", "PNG": ".png"}
+
+image_cache = LRUCache(IMAGE_CACHE_SIZE)
+
+
+def _save(image, path, side, quality):
+    image = image.convert("RGB")
+    image.thumbnail((side, side), Image.LANCZOS)
+    image.save(path, PREVIEW_FORMAT, quality=quality)
+
+
+def save_preview_tiers(image, name, preview_dir=PREVIEW_DIR):
+    """Write the thumbnail and LLM tiers of a page image; returns their paths as entry fields"""
+    os.makedirs(preview_dir, exist_ok=True)
+    extension = _EXTENSIONS.get(PREVIEW_FORMAT, "." + PREVIEW_FORMAT.lower())
+    paths = {
+        "preview": os.path.join(preview_dir, f"{name}.thumb{extension}"),
+        "llm_image": os.path.join(preview_dir, f"{name}.llm{extension}"),
+    }
+    with span("preview_write"):
+        _save(image, paths["preview"], PREVIEW_THUMB_SIDE, PREVIEW_THUMB_QUALITY)
+        _save(image, paths["llm_image"], PREVIEW_LLM_SIDE, PREVIEW_LLM_QUALITY)
+    return paths
+
+
+def remove_preview_files(entry):
+    for field in ("preview", "llm_image"):
+        if entry.get(field):
+            try:
+                os.remove(entry[field])
+            except OSError:
+                pass
+
+
+def load_image(entry, tier="llm"):
+    """Decoded page image of an entry (``"llm"`` or ``"thumb"`` tier), from the in-memory LRU when possible.
+
+    Entries indexed before tiered previews only have a full-size ``preview``,
+    which serves both tiers. Callers must not modify the returned image.
+    """
+    key = (entry["doc_id"], tier)
+    image = image_cache.get(key)
+    if image is None:
+        path = entry["llm_image"] if tier == "llm" and entry.get("llm_image") else entry["preview"]
+        with span("preview_read"):
+            image = Image.open(path)
+            if not entry.get("llm_image"):
+                # Full-size legacy PNG: keep only what the tier needs in memory
+                side = PREVIEW_LLM_SIDE if tier == "llm" else PREVIEW_THUMB_SIDE
+                image.thumbnail((side, side), Image.LANCZOS)
+            image.load()
+        image_cache.put(key, image)
+    return image
@@ -0,0 +1,174 @@
+import os
+import re
+import time
+import random
+import hashlib
+import threading
+from types import SimpleNamespace
+import numpy as np
+from config import EMBED_PROVIDER, LLM_PROVIDER, COHERE_API_KEY, GEMINI_API_KEY
+
+# Fake providers: embedding size; latency per call and per input (embeddings)
+# or per generated token (LLM), in seconds; length of generated answers; the
+# share of calls that fail with a retryable error (HTTP 429/503); and the seed
+# that makes vectors, answers and injected errors reproducible
+FAKE_EMBED_DIM = int(os.getenv('FAKE_EMBED_DIM', 1536))
+FAKE_EMBED_LATENCY = float(os.getenv('FAKE_EMBED_LATENCY', 0.05))
+FAKE_EMBED_LATENCY_PER_INPUT = float(os.getenv('FAKE_EMBED_LATENCY_PER_INPUT', 0.002))
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', 0.5))
+FAKE_LLM_LATENCY_PER_TOKEN = float(os.getenv('FAKE_LLM_LATENCY_PER_TOKEN', 0.01))
+FAKE_LLM_ANSWER_TOKENS = int(os.getenv('FAKE_LLM_ANSWER_TOKENS', 60))
+FAKE_ERROR_RATE = float(os.getenv('FAKE_ERROR_RATE', 0.0))
+FAKE_SEED = int(os.getenv('FAKE_SEED', 0))
+
+_WORD = re.compile(r"\w+")
+
+
+class ProviderError(Exception):
+    """An error injected by a fake provider, shaped like the real clients' HTTP errors"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = {}
+
+
+class _Faults:
+    """Seeded error injection shared by the calls of one fake client"""
+
+    def __init__(self, error_rate, seed):
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def check(self, name):
+        if self.error_rate <= 0:
+            return
+        with self._lock:
+            fail = self._random.random() < self.error_rate
+            status = self._random.choice((429, 503))
+        if fail:
+            raise ProviderError(status, f"Injected {name} error (status {status})")
+
+
+def _digest(value, seed):
+    return hashlib.blake2b(f"{seed}\0{value}".encode("utf-8"), digest_size=8).digest()
+
+
+class FakeEmbedClient:
+    """Deterministic stand-in for the Cohere client's ``embed()``.
+
+    Texts are embedded by feature hashing their words, so texts sharing words
+    get similar vectors and search results stay meaningful; other inputs
+    (images) get a pseudo-random vector derived from their content. Vectors
+    are unit length and depend only on the input and the seed.
+    """
+
+    def __init__(self, dim=FAKE_EMBED_DIM, latency=FAKE_EMBED_LATENCY, latency_per_input=FAKE_EMBED_LATENCY_PER_INPUT,
+                 error_rate=FAKE_ERROR_RATE, seed=FAKE_SEED):
+        self.dim = dim
+        self.latency = latency
+        self.latency_per_input = latency_per_input
+        self.seed = seed
+        self.calls = 0
+        self._faults = _Faults(error_rate, seed)
+
+    def _text_vector(self, text):
+        vector = np.zeros(self.dim, dtype="float32")
+        for word in _WORD.findall(text.lower()):
+            h = int.from_bytes(_digest(word, self.seed), "little")
+            vector[h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        return vector
+
+    def _vector(self, content, is_text):
+        vector = self._text_vector(content) if is_text else np.zeros(self.dim, dtype="float32")
+        if not vector.any():
+            rng = np.random.default_rng(int.from_bytes(_digest(content, self.seed), "little"))
+            vector = rng.standard_normal(self.dim).astype("float32")
+        return vector / np.linalg.norm(vector)
+
+    def embed(self, model=None, input_type=None, embedding_types=None, texts=None, inputs=None):
+        self.calls += 1
+        count = len(texts if texts is not None else inputs)
+        time.sleep(self.latency + self.latency_per_input * count)
+        self._faults.check("embed")
+        if texts is not None:
+            vectors = [self._vector(text, True) for text in texts]
+        else:
+            vectors = [
+                self._vector("".join(part.get("image_url", {}).get("url", "") for part in item["content"]), False)
+                for item in inputs
+            ]
+        return SimpleNamespace(embeddings=SimpleNamespace(float=np.vstack(vectors)))
+
+
+class FakeGenerativeModel:
+    """Deterministic stand-in for ``google.generativeai.GenerativeModel``"""
+
+    def __init__(self, client, model_name):
+        self.client = client
+        self.model_name = model_name
+
+    def _answer(self, prompt):
+        parts = prompt if isinstance(prompt, list) else [prompt]
+        text = "\n".join(part for part in parts if isinstance(part, str))
+        question = text.rsplit("Question:", 1)[-1].strip()
+        images = sum(1 for part in parts if not isinstance(part, str))
+        rng = random.Random(int.from_bytes(_digest(text, self.client.seed), "little"))
+        words = _WORD.findall(text) or ["answer"]
+        filler = [rng.choice(words) for _ in range(max(0, self.client.answer_tokens - 8))]
+        return f"Answer to {question!r} from {images} images: " + " ".join(filler)
+
+    def _tokens(self, prompt):
+        time.sleep(self.client.latency)
+        self.client._faults.check("generate_content")
+        for word in self._answer(prompt).split(" "):
+            time.sleep(self.client.latency_per_token)
+            yield word + " "
+
+    def generate_content(self, prompt, stream=False):
+        self.client.calls += 1
+        if stream:
+            return (SimpleNamespace(text=token) for token in self._tokens(prompt))
+        return SimpleNamespace(text="".join(self._tokens(prompt)).strip())
+
+
+class FakeLLMClient:
+    """Stand-in for the ``google.generativeai`` module: ``GenerativeModel(name).generate_content()``"""
+
+    def __init__(self, latency=FAKE_LLM_LATENCY, latency_per_token=FAKE_LLM_LATENCY_PER_TOKEN,
+                 answer_tokens=FAKE_LLM_ANSWER_TOKENS, error_rate=FAKE_ERROR_RATE, seed=FAKE_SEED):
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.answer_tokens = answer_tokens
+        self.seed = seed
+        self.calls = 0
+        self._faults = _Faults(error_rate, seed + 1)
+
+    def GenerativeModel(self, model_name):
+        return FakeGenerativeModel(self, model_name)
+
+
+def make_embed_client(provider=EMBED_PROVIDER):
+    """Client with Cohere's ``embed()`` interface for ``provider`` ("cohere" or "fake")"""
+    if provider == "fake":
+        return FakeEmbedClient()
+    if provider == "cohere":
+        if not COHERE_API_KEY:
+            raise RuntimeError("COHERE_API_KEY is not set; set it, or EMBED_PROVIDER=fake to run without Cohere")
+        import cohere
+        return cohere.ClientV2(api_key=COHERE_API_KEY)
+    raise ValueError(f"Unknown EMBED_PROVIDER {provider!r}; expected 'cohere' or 'fake'")
+
+
+def make_llm_client(provider=LLM_PROVIDER):
+    """Client with the ``google.generativeai`` interface for ``provider`` ("gemini" or "fake")"""
+    if provider == "fake":
+        return FakeLLMClient()
+    if provider == "gemini":
+        if not GEMINI_API_KEY:
+            raise RuntimeError("GEMINI_API_KEY is not set; set it, or LLM_PROVIDER=fake to run without Gemini")
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        return genai
+    raise ValueError(f"Unknown LLM_PROVIDER {provider!r}; expected 'gemini' or 'fake'")
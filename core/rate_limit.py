@@ -0,0 +1,124 @@
+import random
+import threading
+import time
+
+import httpx
+
+from core.metrics import provider_errors, provider_retries
+
+RETRYABLE_STATUS = {408, 429}
+
+
+class TokenBucket:
+    """Token-bucket limiter on request starts, shared by every caller of a provider"""
+
+    def __init__(self, rate_per_sec, capacity=None):
+        self.rate = rate_per_sec
+        self.capacity = capacity or max(1.0, rate_per_sec)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """Limit on in-flight requests that adapts to throttling and latency.
+
+    Additive increase while per-input latency stays near the best recently
+    observed value; the limit halves on a throttle and shrinks by one when
+    latency climbs past ``latency_tolerance`` times that baseline.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=16, latency_tolerance=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self._baseline = None
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif latency is not None:
+                # Let the baseline drift up slowly so one fast outlier does not pin it
+                self._baseline = latency if self._baseline is None else min(latency, self._baseline * 1.05)
+                if latency > self._baseline * self.latency_tolerance:
+                    self.limit = max(self.minimum, self.limit - 1)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+def error_status(error):
+    return getattr(error, "status_code", None)
+
+
+def is_retryable(error):
+    """Throttling, provider-side failures and dropped connections are worth retrying"""
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_backoff(fn, bucket=None, concurrency=None, size=1, max_retries=5, base_delay=0.5, max_delay=30.0,
+                      api="embed"):
+    """Call ``fn()`` under the limiters, retrying retryable errors with exponential backoff.
+
+    ``size`` is the number of inputs in the request, used to normalise latency
+    for the concurrency controller. The last error is re-raised once retries
+    are exhausted or the error is not retryable. Errors and retries are
+    counted in the provider metrics under ``api``.
+    """
+    for attempt in range(max_retries + 1):
+        if bucket:
+            bucket.acquire()
+        if concurrency:
+            concurrency.acquire()
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            retryable = is_retryable(e)
+            provider_errors.inc(api=api, status=error_status(e) or type(e).__name__)
+            if concurrency:
+                concurrency.release(throttled=retryable)
+            if not retryable or attempt == max_retries:
+                raise
+            delay = _retry_after(e) or random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            provider_retries.inc(api=api)
+            print(f"Retrying after {type(e).__name__} (status {error_status(e)}) in {delay:.1f}s")
+            time.sleep(delay)
+        else:
+            if concurrency:
+                concurrency.release(latency=(time.monotonic() - started) / max(size, 1))
+            return result
@@ -1,59 +1,329 @@
+import os
+import time
+import hashlib
 import numpy as np
 from PIL import Image
-from config import GEMINI_API_KEY, GEMINI_MODEL
-import google.generativeai as genai
+from config import GEMINI_MODEL, LLM_PROVIDER
+from core.providers import make_llm_client
+from core.cache import make_cache, normalize_query
+from core.index_factory import search, reconstruct_many
+from core.metrics import provider_errors
+from core.tracing import span, record
+from core.rate_limit import error_status
 
-# Initialize Gemini
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_client = genai
+# Answer cache: "memory", "disk" or "none"; entries and time-to-live in seconds
+ANSWER_CACHE_BACKEND = os.getenv('ANSWER_CACHE_BACKEND', 'memory')
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 512))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', 86400))
 
-def search_documents(query, index, docs_info, query_embed_fn, top_k=3):
-    query_vector = query_embed_fn(query)
-    if query_vector is None or index is None:
-        return []
+# Retrieval: "hybrid" fuses vector and BM25 keyword hits, "vector" and
+# "lexical" use one of them ("lexical" needs no embedding call). Hybrid
+# search fuses the top SEARCH_FUSION_DEPTH of each with reciprocal-rank
+# fusion, constant SEARCH_RRF_K.
+SEARCH_MODES = ("hybrid", "vector", "lexical")
+SEARCH_MODE = os.getenv('SEARCH_MODE', 'hybrid')
+SEARCH_FUSION_DEPTH = int(os.getenv('SEARCH_FUSION_DEPTH', 50))
+SEARCH_RRF_K = int(os.getenv('SEARCH_RRF_K', 60))
 
-    D, I = index.search(np.array([query_vector.astype("float32")]), top_k)
-    results = []
+# Optional diversification of results: from the top SEARCH_DIVERSIFY_CANDIDATES,
+# hits from an already returned source page or whose vector is at least
+# SEARCH_DUPLICATE_SIMILARITY (cosine) to a returned one are collapsed, and
+# the rest are reranked by maximal marginal relevance (SEARCH_MMR_LAMBDA
+# weighs relevance against novelty)
+SEARCH_DIVERSIFY = os.getenv('SEARCH_DIVERSIFY', 'false').lower() in ('1', 'true', 'yes')
+SEARCH_DIVERSIFY_CANDIDATES = int(os.getenv('SEARCH_DIVERSIFY_CANDIDATES', 50))
+SEARCH_MMR_LAMBDA = float(os.getenv('SEARCH_MMR_LAMBDA', 0.7))
+SEARCH_DUPLICATE_SIMILARITY = float(os.getenv('SEARCH_DUPLICATE_SIMILARITY', 0.97))
+
+# Initialize Gemini (or its stand-in, see LLM_PROVIDER)
+gemini_client = make_llm_client()
+# Answers from a fake LLM are cached apart from real ones
+LLM_MODEL = GEMINI_MODEL if LLM_PROVIDER == "gemini" else f"{LLM_PROVIDER}-llm"
+
+answer_cache = make_cache(ANSWER_CACHE_BACKEND, "answer_cache", ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+
+def _vector_ranking(distances, ids):
+    return [(int(idx), float(1 / (1 + score))) for score, idx in zip(distances, ids) if idx >= 0]
+
+def _lexical_ranking(query, docs_info, depth, filters):
+    # BM25 scores are unbounded; map them into (0, 1) like vector similarities
+    with span("lexical_search"):
+        matches = docs_info.search_text(query, depth, **filters)
+    return [(idx, score / (1 + score)) for idx, score in matches]
+
+def _live(ranking, docs_info, exclude_ids):
+    """Drop deleted ids and ids without metadata, so they take no rank"""
+    return [(idx, score) for idx, score in ranking if idx not in exclude_ids and docs_info.get(idx) is not None]
+
+def _fuse(rankings, k=SEARCH_RRF_K):
+    """Reciprocal-rank fusion: an id scores sum(1 / (k + rank)) over the rankings it appears in"""
+    scores = {}
+    for ranking in rankings:
+        for rank, (idx, _) in enumerate(ranking, 1):
+            scores[idx] = scores.get(idx, 0.0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def _combine(rankings, mode):
+    if mode == "hybrid":
+        return _fuse(rankings)
+    return rankings[0] if rankings else []
+
+def _page_key(doc_info):
+    return doc_info["content_type"], doc_info["source"], doc_info.get("page", 1)
 
-    for score, idx in zip(D[0], I[0]):
-        if idx < len(docs_info):
-            doc_info = docs_info[idx]
-            results.append({
-                "doc_id": doc_info["doc_id"],
-                "source": doc_info["source"],
-                "content_type": doc_info["content_type"],
-                "page": doc_info.get("page", 1),
-                "similarity": 1 / (1 + score),
-                "content": doc_info.get("content"),
-                "preview": doc_info.get("preview"),
-            })
+def _diversify(ranking, index, docs_info, top_k, mmr_lambda=SEARCH_MMR_LAMBDA,
+               duplicate_similarity=SEARCH_DUPLICATE_SIMILARITY):
+    """Pick top_k of a ranking by maximal marginal relevance, collapsing near-duplicates.
 
+    Relevance is the ranking score scaled to [0, 1]; redundancy is the cosine
+    similarity to hits already picked, from one similarity matrix over the
+    candidates' stored vectors. A candidate from a page already picked (same
+    content type, source and page) or a near-copy of a picked one is dropped.
+    """
+    if len(ranking) <= 1 or index is None:
+        return ranking[:top_k]
+    ids = np.array([idx for idx, _ in ranking], dtype="int64")
+    scores = np.array([score for _, score in ranking], dtype="float32")
+    stored_ids, stored = reconstruct_many(index, ids)
+    # Candidates the index does not hold (added concurrently) count as unlike any other
+    vectors = np.zeros((len(ids), index.d), dtype="float32")
+    rows = {int(i): row for row, i in enumerate(ids)}
+    vectors[[rows[int(i)] for i in stored_ids]] = stored
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+
+    score_range = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / score_range if score_range > 0 else np.ones_like(scores)
+    max_similarity = np.full(len(ids), -1.0, dtype="float32")
+    available = np.ones(len(ids), dtype=bool)
+    pages = set()
+    picked = []
+    while len(picked) < top_k and available.any():
+        mmr = mmr_lambda * relevance - (1 - mmr_lambda) * np.maximum(max_similarity, 0)
+        best = int(np.argmax(np.where(available, mmr, -np.inf)))
+        available[best] = False
+        key = _page_key(docs_info.get(ids[best]))
+        if key in pages or max_similarity[best] >= duplicate_similarity:
+            continue
+        pages.add(key)
+        picked.append(ranking[best])
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return picked
+
+def _similarities(ids, index, query_vector, found):
+    """Vector similarity of each id: as found by the vector search, else from its stored vector.
+
+    Ids reach the hits without a vector search hit through keyword search;
+    without a query vector (lexical mode) there is none.
+    """
+    similarities = dict(found)
+    missing = [idx for idx in ids if idx not in similarities]
+    if missing and query_vector is not None and index is not None:
+        stored_ids, vectors = reconstruct_many(index, missing)
+        # Squared L2, like the index distances in _vector_ranking
+        distances = ((vectors - query_vector) ** 2).sum(axis=1)
+        similarities.update((int(idx), float(1 / (1 + distance))) for idx, distance in zip(stored_ids, distances))
+    return similarities
+
+def _hits(ranking, docs_info, top_k, similarities):
+    """Search hits for the first top_k ``(vector_id, score)`` pairs of a ranking"""
+    ranking = ranking[:top_k]
+    doc_infos = [docs_info.get(idx) for idx, _ in ranking]
+    results = []
+    for (idx, score), doc_info, content in zip(ranking, doc_infos, docs_info.contents(doc_infos)):
+        results.append({
+            "doc_id": doc_info["doc_id"],
+            "source": doc_info["source"],
+            "content_type": doc_info["content_type"],
+            "page": doc_info.get("page", 1),
+            "similarity": similarities.get(idx),
+            "score": score,
+            "content": content,
+            "preview": doc_info.get("preview"),
+            "llm_image": doc_info.get("llm_image"),
+            "width": doc_info.get("width"),
+            "height": doc_info.get("height"),
+        })
     return results
 
-def answer_with_gemini(question, content):
-    try:
-        model = gemini_client.GenerativeModel(GEMINI_MODEL)
+def _select(rankings, mode, index, docs_info, top_k, diversify, query_vector=None, vector_ranking=()):
+    ranking = _combine(rankings, mode)
+    if diversify:
+        with span("diversify"):
+            ranking = _diversify(ranking, index, docs_info, top_k)
+    with span("load_hits"):
+        similarities = _similarities([idx for idx, _ in ranking[:top_k]], index, query_vector, vector_ranking)
+        return _hits(ranking, docs_info, top_k, similarities)
+
+def _depth(mode, top_k, diversify):
+    """Candidates to fetch from each retriever"""
+    depth = top_k if mode == "vector" else max(top_k, SEARCH_FUSION_DEPTH)
+    return max(depth, SEARCH_DIVERSIFY_CANDIDATES) if diversify else depth
+
+def _check_mode(mode):
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode!r}; expected one of {', '.join(SEARCH_MODES)}")
 
-        if isinstance(content, Image.Image):
-            prompt = [f"""Answer the question based on the following image.
+def _vector_search(index, queries, depth, allowed, exclude_ids, nprobe, ef_search):
+    with span("index_search"):
+        return _index_search(index, queries, depth, allowed, exclude_ids, nprobe, ef_search)
+
+def _index_search(index, queries, depth, allowed, exclude_ids, nprobe, ef_search):
+    if allowed is not None:
+        # Only live entries are selected, so there is nothing to over-fetch for
+        return search(index, queries, min(depth, len(allowed)), nprobe=nprobe, ef_search=ef_search, ids=allowed)
+    return search(index, queries, min(depth, index.ntotal), nprobe=nprobe, ef_search=ef_search,
+                  exclude_ids=exclude_ids)
+
+def search_documents(query, index, docs_info, query_embed_fn, top_k=3, nprobe=None, ef_search=None,
+                     exclude_ids=frozenset(), mode=SEARCH_MODE, content_type=None, source=None, doc_id_prefix=None,
+                     diversify=SEARCH_DIVERSIFY):
+    """Top-k hits for a query; nprobe/ef_search tune IVF/HNSW indexes per call.
+
+    ``mode`` picks vector, keyword (BM25) or hybrid retrieval (see
+    SEARCH_MODE). Hits are ranked by "score": the vector similarity, the BM25
+    score scaled into (0, 1), or the fused score respectively. "similarity"
+    is always the vector similarity to the query (None in lexical mode, which
+    embeds nothing). ``exclude_ids`` are
+    deleted (tombstoned) vector_ids still in the index; the index search
+    skips them with an id selector, so they do not eat into the top k.
+
+    ``content_type``, ``source`` and ``doc_id_prefix`` restrict the search to
+    matching entries: the index is searched for those vector_ids only, so
+    e.g. the best image page costs one k=1 search rather than an over-fetch.
+    ``diversify`` reranks a larger candidate set so near-duplicate pages do
+    not fill the top k (see SEARCH_DIVERSIFY).
+    """
+    _check_mode(mode)
+    filters = {"content_type": content_type, "source": source, "doc_id_prefix": doc_id_prefix}
+    allowed = docs_info.select(**filters)
+    if allowed is not None and len(allowed) == 0:
+        return []
+    depth = _depth(mode, top_k, diversify)
+    rankings = []
+    query_vector = None
+    vector_ranking = []
+    if mode != "lexical":
+        query_vector = query_embed_fn(query)
+        if query_vector is not None and index is not None and index.ntotal:
+            query_vector = query_vector.astype("float32")
+            D, I = _vector_search(index, np.array([query_vector]), depth, allowed, exclude_ids, nprobe, ef_search)
+            vector_ranking = _live(_vector_ranking(D[0], I[0]), docs_info, exclude_ids)
+            rankings.append(vector_ranking)
+    if mode != "vector":
+        rankings.append(_live(_lexical_ranking(query, docs_info, depth, filters), docs_info, exclude_ids))
+    return _select(rankings, mode, index, docs_info, top_k, diversify, query_vector, vector_ranking)
+
+def search_documents_batch(queries, index, docs_info, query_embeds_fn, top_k=3, nprobe=None, ef_search=None,
+                           exclude_ids=frozenset(), mode=SEARCH_MODE, content_type=None, source=None,
+                           doc_id_prefix=None, diversify=SEARCH_DIVERSIFY):
+    """search_documents for many queries: one batched embedding and one index search over the query matrix.
+
+    ``query_embeds_fn`` returns ``(matrix, embedded mask)`` for a list of
+    queries (see get_query_embeddings). Filters apply to every query. Returns
+    one hit list per query; in vector mode, empty for queries that could not
+    be embedded.
+    """
+    _check_mode(mode)
+    filters = {"content_type": content_type, "source": source, "doc_id_prefix": doc_id_prefix}
+    allowed = docs_info.select(**filters)
+    rankings = [[] for _ in queries]
+    if allowed is not None and len(allowed) == 0:
+        return rankings
+    depth = _depth(mode, top_k, diversify)
+    query_vectors = [None] * len(queries)
+    vector_rankings = [[] for _ in queries]
+    if mode != "lexical" and queries and index is not None and index.ntotal:
+        vectors, ok = query_embeds_fn(queries)
+        rows = np.flatnonzero(ok)
+        if len(rows):
+            matrix = np.ascontiguousarray(vectors[rows], dtype="float32")
+            D, I = _vector_search(index, matrix, depth, allowed, exclude_ids, nprobe, ef_search)
+            for row, query_vector, distances, ids in zip(rows, matrix, D, I):
+                query_vectors[row] = query_vector
+                vector_rankings[row] = _live(_vector_ranking(distances, ids), docs_info, exclude_ids)
+                rankings[row].append(vector_rankings[row])
+    if mode != "vector":
+        for query, query_rankings in zip(queries, rankings):
+            query_rankings.append(_live(_lexical_ranking(query, docs_info, depth, filters), docs_info, exclude_ids))
+    return [
+        _select(query_rankings, mode, index, docs_info, top_k, diversify, query_vector, vector_ranking)
+        for query_rankings, query_vector, vector_ranking in zip(rankings, query_vectors, vector_rankings)
+    ]
+
+def answer_cache_key(question, top_k, context, generation):
+    """Cache key for an answer: question, retrieval depth, the context sent (see context_key) and index generation"""
+    h = hashlib.sha256()
+    for part in (LLM_MODEL, normalize_query(question), str(top_k), str(generation), context or ""):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _gemini_prompt(question, content):
+    """``content`` is text, an image, or a list of text and image parts (see core.context)"""
+    if isinstance(content, list):
+        return ["""Answer the question based on the following numbered sources (text excerpts and page images).
+Don't use markdown.
+Please provide enough context for your answer.""", *content, f"Question: {question}"]
+    if isinstance(content, Image.Image):
+        return [f"""Answer the question based on the following image.
 Don't use markdown.
 Please provide enough context for your answer.
 
 Question: {question}""", content]
-            response = model.generate_content(contents=prompt)
-        else:
-            prompt = f"""Answer the question based on the following information.
+    return f"""Answer the question based on the following information.
 Don't use markdown.
 Please provide enough context for your answer.
 
 Information: {content}
 
 Question: {question}"""
-            response = model.generate_content(prompt)
 
-        answer = response.text
+def answer_with_gemini(question, content, cache_key=None):
+    """Answer from text or an image; successful answers are stored in answer_cache under cache_key"""
+    try:
+        model = gemini_client.GenerativeModel(GEMINI_MODEL)
+        with span("llm_generate"):
+            response = model.generate_content(_gemini_prompt(question, content))
+            answer = response.text
         print("LLM Answer:", answer)
-        return answer.strip() if answer else "Gemini returned no answer."
+        if not answer:
+            return "Gemini returned no answer."
+        if cache_key is not None:
+            answer_cache.put(cache_key, answer.strip())
+        return answer.strip()
     except Exception as e:
+        provider_errors.inc(api="llm", status=error_status(e) or type(e).__name__)
         print("Gemini error:", str(e))
         return f"Gemini error: {e}"
+
+def stream_answer_with_gemini(question, content, cache_key=None):
+    """Like answer_with_gemini, but yields the answer in pieces as Gemini generates them"""
+    parts = []
+    started = time.perf_counter()
+    try:
+        model = gemini_client.GenerativeModel(GEMINI_MODEL)
+        for chunk in model.generate_content(_gemini_prompt(question, content), stream=True):
+            try:
+                text = chunk.text
+            except ValueError:
+                # A chunk without text parts (e.g. only a finish reason)
+                continue
+            if text:
+                if not parts:
+                    record("llm_first_token", time.perf_counter() - started, started)
+                parts.append(text)
+                yield text
+    except Exception as e:
+        provider_errors.inc(api="llm", status=error_status(e) or type(e).__name__)
+        print("Gemini error:", str(e))
+        yield f"Gemini error: {e}" if not parts else f" [Gemini error: {e}]"
+        return
+
+    record("llm_generate", time.perf_counter() - started, started)
+    answer = "".join(parts).strip()
+    print("LLM Answer:", answer)
+    if not answer:
+        yield "Gemini returned no answer."
+    elif cache_key is not None:
+        answer_cache.put(cache_key, answer)
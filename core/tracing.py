@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from core.metrics import stage_seconds
+
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# Spans kept per trace with their start times; later spans only add to the
+# per-stage totals, so a 1000-page upload does not keep 1000s of spans
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 500))
+
+# Sampling profiler: fraction of requests and ingestion jobs profiled and
+# seconds between stack samples. Both can be changed at runtime through
+# PROFILE_SWITCH_FILE (see set_profiling), which every process checks
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0.0))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+# Profiles kept in PROFILE_DIR; the oldest are deleted beyond this many
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 200))
+PROFILE_SWITCH_FILE = os.path.join(DATA_DIR, "profiling.json")
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Timed spans of one request or ingestion job, recorded from any thread working on it"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.finished = None
+        self.spans = []
+        self.totals = {}
+        self.dropped = 0
+        self._threads = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, started, duration):
+        with self._lock:
+            count, total = self.totals.get(name, (0, 0.0))
+            self.totals[name] = (count + 1, total + duration)
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append((name, started - self.started, duration))
+            else:
+                self.dropped += 1
+
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def finish(self):
+        """Stop the clock: total time stays that of the work, not of when timings are read"""
+        self.finished = time.perf_counter()
+
+    def timings(self):
+        """Spans in start order and per-stage totals, in milliseconds"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])
+            totals = dict(self.totals)
+            dropped = self.dropped
+        return {
+            "total_ms": round(self.elapsed() * 1000, 3),
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                for name, start, duration in spans
+            ],
+            "stages": {
+                name: {"count": count, "total_ms": round(total * 1000, 3)} for name, (count, total) in totals.items()
+            },
+            "dropped_spans": dropped,
+        }
+
+    def server_timing(self):
+        """Server-Timing header value: total milliseconds per stage, then the whole request"""
+        with self._lock:
+            totals = list(self.totals.items())
+        parts = [
+            f"{name};dur={total * 1000:.1f}" + (f';desc="{count} calls"' if count > 1 else "")
+            for name, (count, total) in totals
+        ]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def enter_thread(self):
+        with self._lock:
+            self._threads[threading.get_ident()] += 1
+
+    def exit_thread(self):
+        with self._lock:
+            ident = threading.get_ident()
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def threads(self):
+        """Idents of the threads currently working on this trace"""
+        with self._lock:
+            return list(self._threads)
+
+
+@contextmanager
+def activate(trace):
+    """Make ``trace`` the current trace of this thread for the ``with`` block"""
+    if trace is None:
+        yield
+        return
+    token = current_trace.set(trace)
+    trace.enter_thread()
+    try:
+        yield trace
+    finally:
+        trace.exit_thread()
+        current_trace.reset(token)
+
+
+def traced(fn):
+    """``fn`` bound to the caller's trace, for running on another thread (thread pools do not carry it)"""
+    trace = current_trace.get()
+    if trace is None:
+        return fn
+
+    def run(*args, **kwargs):
+        with activate(trace):
+            return fn(*args, **kwargs)
+    return run
+
+
+def record(name, duration, started=None, count=1):
+    """Record a measured stage: observed in the stage metrics and added to the current trace.
+
+    ``count`` items handled together (e.g. pages rendered in one call) are
+    observed as that many equal shares of ``duration``, and traced as one span.
+    """
+    for _ in range(count):
+        stage_seconds.observe(duration / count, stage=name)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, time.perf_counter() - duration if started is None else started, duration)
+
+
+@contextmanager
+def span(name):
+    """Time the ``with`` block as stage ``name`` (see record), also when it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started, started)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    """Samples the stacks of the threads working on a trace, for a flame graph.
+
+    Every ``interval`` seconds a background thread records the stack of each
+    thread active in the trace. ``stop()`` writes the samples in the folded
+    format (one ``root;...;leaf count`` line per distinct stack) read by
+    flamegraph.pl, speedscope and similar tools.
+    """
+
+    def __init__(self, trace, interval=PROFILE_INTERVAL, profile_dir=PROFILE_DIR):
+        self.trace = trace
+        self.interval = interval
+        self.path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.folded")
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in self.trace.threads():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and write the profile; returns its path"""
+        self._stop.set()
+        self._thread.join()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        _prune_profiles(os.path.dirname(self.path))
+        return self.path
+
+
+def _prune_profiles(profile_dir, keep=PROFILE_MAX_FILES):
+    """Delete all but the ``keep`` newest profiles (file names start with their time)"""
+    names = sorted(name for name in os.listdir(profile_dir) if name.endswith(".folded"))
+    for name in names[:max(0, len(names) - keep)]:
+        try:
+            os.remove(os.path.join(profile_dir, name))
+        except OSError:
+            pass  # already deleted by another process
+
+
+_switch = {"mtime": None, "settings": {"sample_rate": PROFILE_SAMPLE_RATE, "interval": PROFILE_INTERVAL}}
+
+
+def profiling_settings():
+    """Current profiler settings: PROFILE_SWITCH_FILE when present, else the environment defaults"""
+    try:
+        mtime = os.stat(PROFILE_SWITCH_FILE).st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime != _switch["mtime"]:
+        settings = {"sample_rate": PROFILE_SAMPLE_RATE, "interval": PROFILE_INTERVAL}
+        if mtime is not None:
+            try:
+                with open(PROFILE_SWITCH_FILE) as f:
+                    settings.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable {PROFILE_SWITCH_FILE}: {e}")
+        _switch["mtime"], _switch["settings"] = mtime, settings
+    return dict(_switch["settings"])
+
+
+def set_profiling(sample_rate=None, interval=None):
+    """Change the profiler settings of every process sharing DATA_DIR; returns the new settings"""
+    settings = profiling_settings()
+    if sample_rate is not None:
+        settings["sample_rate"] = min(1.0, max(0.0, float(sample_rate)))
+    if interval is not None:
+        settings["interval"] = max(0.0005, float(interval))
+    with open(PROFILE_SWITCH_FILE + ".tmp", "w") as f:
+        json.dump(settings, f)
+    os.replace(PROFILE_SWITCH_FILE + ".tmp", PROFILE_SWITCH_FILE)
+    return settings
+
+
+def maybe_profile(trace):
+    """A started Profiler for ``trace`` for the sampled fraction of calls, else None"""
+    settings = profiling_settings()
+    if settings["sample_rate"] <= 0 or random.random() >= settings["sample_rate"]:
+        return None
+    return Profiler(trace, interval=settings["interval"]).start()
@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# Offline providers and a scratch data dir, set before config is imported
+os.environ.setdefault("EMBED_PROVIDER", "fake")
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("FAKE_EMBED_DIM", "64")
+os.environ.setdefault("FAKE_EMBED_LATENCY", "0")
+os.environ.setdefault("FAKE_EMBED_LATENCY_PER_INPUT", "0")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="rag-tests-"))
@@ -0,0 +1,45 @@
+from core.chunking import chunk_pages, count_tokens, truncate_tokens
+
+
+def words(prefix, count):
+    return " ".join(f"{prefix}{i}" for i in range(count))
+
+
+def test_long_page_is_split_into_overlapping_windows():
+    chunks = chunk_pages([(3, words("w", 25))], max_tokens=10, overlap=3)
+    assert [count_tokens(c["text"]) for c in chunks] == [10, 10, 10, 4]
+    assert all(c["page"] == c["page_end"] == 3 for c in chunks)
+    # Each window starts max_tokens - overlap words after the previous one
+    assert [c["text"].split()[0] for c in chunks] == ["w0", "w7", "w14", "w21"]
+    assert chunks[-1]["text"].split()[-1] == "w24"
+
+
+def test_overlap_boundary():
+    first, second = chunk_pages([(1, words("w", 12))], max_tokens=8, overlap=4)
+    assert first["text"].split()[-4:] == second["text"].split()[:4]
+    assert second["text"].split() == [f"w{i}" for i in range(4, 12)]
+
+    # A page of exactly max_tokens words is not split
+    assert len(chunk_pages([(1, words("w", 8))], max_tokens=8, overlap=4)) == 1
+
+
+def test_short_pages_are_merged_while_they_fit():
+    pages = [(1, words("a", 4)), (2, words("b", 4)), (3, words("c", 4)), (4, "")]
+    chunks = chunk_pages(pages, max_tokens=10, overlap=2)
+    assert [(c["page"], c["page_end"]) for c in chunks] == [(1, 2), (3, 3)]
+    assert chunks[0]["text"] == words("a", 4) + "\n" + words("b", 4)
+    assert chunks[1]["text"] == words("c", 4)
+
+
+def test_chunks_start_at_a_page_boundary():
+    pages = [(1, words("a", 3)), (2, words("b", 12))]
+    chunks = chunk_pages(pages, max_tokens=10, overlap=2)
+    assert chunks[0] == {"text": words("a", 3), "page": 1, "page_end": 1}
+    assert all(c["page"] == 2 for c in chunks[1:])
+    assert chunks[1]["text"].split()[0] == "b0"
+
+
+def test_truncate_tokens_keeps_spacing():
+    assert truncate_tokens("one  two\nthree four", 3) == "one  two\nthree"
+    assert truncate_tokens("one two", 5) == "one two"
+    assert truncate_tokens("one two", 0) == ""
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from core import embeddings
+from core.embedding_cache import EmbeddingCache
+from core.providers import FakeEmbedClient
+
+
+class FailingClient(FakeEmbedClient):
+    """Fake client whose calls fail when any text contains "fail" """
+
+    def embed(self, texts=None, **kwargs):
+        if texts and any("fail" in text for text in texts):
+            raise ValueError("embed failed")
+        return super().embed(texts=texts, **kwargs)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    client = FailingClient(dim=16, latency=0, latency_per_input=0)
+    monkeypatch.setattr(embeddings, "co_client", client)
+    monkeypatch.setattr(embeddings, "embedding_cache", EmbeddingCache(str(tmp_path / "cache")))
+    # One input per call, so a failing text fails only its own batch
+    monkeypatch.setattr(embeddings, "MAX_BATCH_INPUTS", 1)
+    return client
+
+
+def texts(*contents):
+    return [(content, "text") for content in contents]
+
+
+def test_all_cache_hits(client):
+    items = texts("alpha beta", "gamma delta")
+    first, first_ok = embeddings.get_document_embeddings(items)
+    calls = client.calls
+
+    second, second_ok = embeddings.get_document_embeddings(items)
+    assert client.calls == calls
+    assert second_ok.all() and first_ok.all()
+    np.testing.assert_array_equal(second, first)
+
+
+def test_cache_hits_kept_when_a_batch_fails(client):
+    cached, _ = embeddings.get_document_embeddings(texts("alpha beta", "gamma delta"))
+
+    vectors, ok = embeddings.get_document_embeddings(texts("alpha beta", "please fail", "gamma delta", "epsilon"))
+    assert ok.tolist() == [True, False, True, True]
+    np.testing.assert_array_equal(vectors[[0, 2]], cached)
+    assert not vectors[1].any()
+    assert vectors[3].any()
+
+
+def test_cache_hits_kept_when_every_batch_fails(client):
+    cached, _ = embeddings.get_document_embeddings(texts("alpha beta"))
+
+    vectors, ok = embeddings.get_document_embeddings(texts("alpha beta", "please fail", "fail again"))
+    assert ok.tolist() == [True, False, False]
+    assert vectors.shape == (3, 16)
+    np.testing.assert_array_equal(vectors[0], cached[0])
+
+
+def test_nothing_embedded(client):
+    vectors, ok = embeddings.get_document_embeddings(texts("please fail"))
+    assert not ok.any()
+    assert embeddings.get_document_embedding("please fail") is None
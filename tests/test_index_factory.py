@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import faiss
+from core.index_factory import (
+    FILTER_EXACT_MAX,
+    LayeredIndex,
+    all_vectors,
+    build_index,
+    compact_index,
+    index_type_of,
+    read_snapshot,
+    search,
+)
+
+DIM = 16
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return np.random.default_rng(0).standard_normal((10000, DIM)).astype("float32")
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf_flat", "ivf_pq", "hnsw"])
+def test_search_params_and_filters(vectors, index_type):
+    index = LayeredIndex(build_index(vectors, index_type)).with_added(vectors[:10] + 0.001, np.arange(10000, 10010))
+    queries = vectors[:5]
+    D, I = search(index, queries, 10, nprobe=8, ef_search=64)
+    assert I.shape == (5, 10)
+
+    # Large filters go through an id selector rather than an exact scan
+    even = np.arange(0, 10010, 2)
+    assert len(even) > FILTER_EXACT_MAX
+    _, I = search(index, queries, 10, nprobe=8, ef_search=64, ids=even)
+    assert (I[I >= 0] % 2 == 0).all()
+
+    excluded = frozenset(range(0, 10010, 3))
+    _, I = search(index, queries, 10, nprobe=8, ef_search=64, exclude_ids=excluded)
+    assert not set(I[I >= 0].tolist()) & excluded
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf_flat", "ivf_pq", "hnsw"])
+def test_compaction_keeps_stored_vectors(vectors, index_type, tmp_path):
+    path = str(tmp_path / "snapshot.faiss")
+    faiss.write_index(build_index(vectors, index_type, np.arange(100, 10100)), path)
+    index = read_snapshot(path).with_added(vectors[:10] + 0.001, np.arange(10100, 10110))
+    # The first compaction folds in the (exact) recent layer, encoding it like the rest
+    index = compact_index(index, frozenset())
+    ids, stored = all_vectors(index)
+    live = dict(zip(ids.tolist(), stored))
+    # Repeated compactions must not move PQ-compressed vectors
+    for step in (7, 11, 13):
+        index = compact_index(index, frozenset(list(live)[::step]))
+        live = {i: v for n, (i, v) in enumerate(live.items()) if n % step}
+        compacted_ids, compacted = all_vectors(index)
+        assert sorted(compacted_ids.tolist()) == sorted(live)
+        np.testing.assert_array_equal(compacted, np.vstack([live[i] for i in compacted_ids.tolist()]))
+    assert index_type_of(index) == index_type
+    vector_id = next(iter(live))
+    np.testing.assert_array_equal(index.reconstruct(vector_id), live[vector_id])
+    _, I = search(index, live[vector_id][None], 1, nprobe=64, ef_search=256)
+    assert I[0, 0] == vector_id
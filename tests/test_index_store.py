@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+from core.document_utils import IndexStore
+from core.index_factory import all_vectors, index_ids, search
+
+DIM = 8
+
+
+def make_docs(prefix, count, content_type="text"):
+    return [
+        {"doc_id": f"{prefix}_chunk_{i}", "source": f"{prefix}.pdf", "content_type": content_type, "page": i + 1,
+         "content": f"{prefix} text {i}", "preview": f"{prefix} text {i}"}
+        for i in range(count)
+    ]
+
+
+def make_vectors(count, seed):
+    return np.random.default_rng(seed).standard_normal((count, DIM)).astype("float32")
+
+
+def stored(store):
+    """{vector_id: vector} of everything the index holds"""
+    ids, vectors = all_vectors(store.index)
+    return {int(i): v for i, v in zip(ids, vectors)}
+
+
+def live(store):
+    """{vector_id: vector} of the vectors that are not tombstoned"""
+    return {i: v for i, v in stored(store).items() if i not in store.tombstones}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return IndexStore(data_dir=str(tmp_path)).load()
+
+
+def test_add_then_reload(store, tmp_path):
+    a, b = make_vectors(5, 0), make_vectors(3, 1)
+    store.add(a, make_docs("a", 5))
+    store.add(b, make_docs("b", 3))
+
+    reloaded = IndexStore(data_dir=str(tmp_path)).load()
+    vectors = stored(reloaded)
+    assert sorted(vectors) == list(range(8))
+    np.testing.assert_array_equal(np.vstack([vectors[i] for i in range(8)]), np.vstack([a, b]))
+    assert sorted(d["doc_id"] for d in reloaded.docs_info) == sorted(d["doc_id"] for d in make_docs("a", 5) + make_docs("b", 3))
+    assert reloaded.docs_info.content(reloaded.docs_info.get(5)) == "b text 0"
+
+
+def test_remove_is_not_searchable_and_survives_reload(store, tmp_path):
+    a = make_vectors(5, 0)
+    store.add(a, make_docs("a", 5))
+    store.add(make_vectors(3, 1), make_docs("b", 3))
+
+    assert store.remove("a_") == 5
+    assert store.tombstones == frozenset(range(5))
+    assert len(store.docs_info) == 3
+    # A removed vector is not returned even for its own query
+    _, I = search(store.index, a, 8, exclude_ids=store.tombstones)
+    assert not set(I[I >= 0].tolist()) & store.tombstones
+    assert (I >= 0).sum(axis=1).tolist() == [3] * 5
+
+    reloaded = IndexStore(data_dir=str(tmp_path)).load()
+    assert reloaded.tombstones == frozenset(range(5))
+    assert sorted(d["vector_id"] for d in reloaded.docs_info) == [5, 6, 7]
+
+
+def test_compact_drops_tombstones_and_keeps_ids(store, tmp_path):
+    a, b = make_vectors(5, 0), make_vectors(3, 1)
+    store.add(a, make_docs("a", 5))
+    store.add(b, make_docs("b", 3))
+    store.remove("a_")
+    store.compact()
+
+    assert store.tombstones == frozenset()
+    assert store.index.ntotal == 3
+    assert sorted(index_ids(store.index).tolist()) == [5, 6, 7]
+
+    reloaded = IndexStore(data_dir=str(tmp_path)).load()
+    vectors = stored(reloaded)
+    assert sorted(vectors) == [5, 6, 7]
+    np.testing.assert_array_equal(np.vstack([vectors[i] for i in (5, 6, 7)]), b)
+
+    # New ids continue after the highest one ever used
+    reloaded.add(make_vectors(2, 2), make_docs("c", 2))
+    assert sorted(d["vector_id"] for d in reloaded.docs_info) == [5, 6, 7, 8, 9]
+
+
+def test_other_process_changes_are_picked_up_by_refresh(store, tmp_path):
+    other = IndexStore(data_dir=str(tmp_path)).load()
+    store.add(make_vectors(4, 0), make_docs("a", 4))
+    assert other.refresh()
+    assert sorted(live(other)) == [0, 1, 2, 3]
+
+    store.remove("a_chunk_1")
+    other.refresh()
+    assert sorted(live(other)) == [0, 2, 3]
+    assert other.docs_info.get(1) is None
+
+    store.compact()
+    other.refresh()
+    assert other.tombstones == frozenset()
+    assert sorted(stored(other)) == [0, 2, 3]
+    assert other.generation == store.generation
+
+
+def test_clear_then_reload(store, tmp_path):
+    store.add(make_vectors(4, 0), make_docs("a", 4))
+    store.clear()
+    reloaded = IndexStore(data_dir=str(tmp_path)).load()
+    assert reloaded.index is None
+    assert len(reloaded.docs_info) == 0
+
+
+def test_filtered_selection_follows_changes(store):
+    store.add(make_vectors(3, 0), make_docs("a", 3))
+    store.add(make_vectors(2, 1), make_docs("b", 2, content_type="image"))
+    images = store.docs_info.select(content_type="image")
+    assert images.tolist() == [3, 4]
+    assert store.docs_info.select(content_type="image") is images
+
+    store.remove("b_chunk_0")
+    assert store.docs_info.select(content_type="image").tolist() == [4]
+    store.add(make_vectors(1, 2), make_docs("c", 1, content_type="image"))
+    assert store.docs_info.select(content_type="image").tolist() == [4, 5]
+    assert store.docs_info.select(content_type="image", source="c.pdf").tolist() == [5]
+    assert store.docs_info.select() is None
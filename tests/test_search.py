@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from core.document_utils import IndexStore
+from core.search import _diversify, _fuse, search_documents
+
+DIM = 4
+
+
+def unit(*values):
+    vector = np.array(values, dtype="float32")
+    return vector / np.linalg.norm(vector)
+
+
+def make_store(data_dir, pages=(1, 2, 3, 4)):
+    store = IndexStore(data_dir=str(data_dir)).load()
+    vectors = np.vstack([
+        unit(1, 0, 0, 0),
+        unit(1, 0.01, 0, 0),  # near-copy of the first, from another page
+        unit(0.8, 0.6, 0, 0),
+        unit(0, 0, 0, 1),
+    ])
+    texts = ["red apples", "red apples again", "green pears", "blue whales swim"]
+    store.add(vectors, [
+        {"doc_id": f"doc_chunk_{i}", "source": "doc.pdf", "content_type": "text", "page": page,
+         "content": text, "preview": text}
+        for i, (text, page) in enumerate(zip(texts, pages))
+    ])
+    return store
+
+
+@pytest.fixture
+def store(tmp_path):
+    return make_store(tmp_path)
+
+
+def test_fuse_orders_by_summed_reciprocal_rank():
+    vector = [(1, 0.9), (2, 0.8), (3, 0.7)]
+    lexical = [(3, 0.99), (1, 0.5), (4, 0.4)]
+    fused = _fuse([vector, lexical], k=60)
+    assert [idx for idx, _ in fused] == [1, 3, 2, 4]
+    scores = dict(fused)
+    assert scores[1] == pytest.approx(1 / 61 + 1 / 62)
+    assert scores[3] == pytest.approx(1 / 63 + 1 / 61)
+    assert scores[2] == pytest.approx(1 / 62)
+    # Only ranks count, not the retrievers' scores
+    assert _fuse([[(5, 0.1)], [(6, 100.0)]], k=60) == [(5, 1 / 61), (6, 1 / 61)]
+
+
+def test_mmr_drops_near_duplicate(store):
+    ranking = [(0, 0.9), (1, 0.89), (2, 0.8), (3, 0.1)]
+    picked = _diversify(ranking, store.index, store.docs_info, 3, mmr_lambda=0.7, duplicate_similarity=0.97)
+    assert [idx for idx, _ in picked] == [0, 2, 3]
+    # Picked hits keep their ranking scores
+    assert picked[0] == (0, 0.9)
+
+    # Without diversity pressure the near-copy is still collapsed
+    picked = _diversify(ranking, store.index, store.docs_info, 2, mmr_lambda=1.0, duplicate_similarity=0.97)
+    assert [idx for idx, _ in picked] == [0, 2]
+
+
+def test_mmr_drops_second_hit_from_same_page(tmp_path):
+    store = make_store(tmp_path, pages=(1, 2, 1, 4))
+    picked = _diversify([(0, 0.9), (2, 0.8), (3, 0.1)], store.index, store.docs_info, 2, duplicate_similarity=1.1)
+    assert [idx for idx, _ in picked] == [0, 3]
+
+
+def test_vector_mode_score_is_similarity(store):
+    query = unit(1, 0, 0, 0)
+    hits = search_documents("", store.index, store.docs_info, lambda q: query, top_k=2, mode="vector")
+    assert [hit["doc_id"] for hit in hits] == ["doc_chunk_0", "doc_chunk_1"]
+    assert hits[0]["similarity"] == pytest.approx(1.0)
+    assert all(hit["score"] == hit["similarity"] for hit in hits)
+
+
+def test_hybrid_score_is_fused_and_similarity_is_vector(store):
+    query = unit(1, 0, 0, 0)
+    hits = search_documents("whales", store.index, store.docs_info, lambda q: query, top_k=4, mode="hybrid")
+    by_id = {hit["doc_id"]: hit for hit in hits}
+    whales = by_id["doc_chunk_3"]
+    # Found by both retrievers: ranked 4th by vector, 1st by keyword
+    assert whales["score"] == pytest.approx(1 / 64 + 1 / 61)
+    # Its similarity is the vector similarity, computed from the stored vector
+    distance = float(((unit(0, 0, 0, 1) - query) ** 2).sum())
+    assert whales["similarity"] == pytest.approx(1 / (1 + distance))
+    assert by_id["doc_chunk_0"]["score"] == pytest.approx(1 / 61)
+    assert by_id["doc_chunk_0"]["similarity"] == pytest.approx(1.0)
+    assert [hit["score"] for hit in hits] == sorted((hit["score"] for hit in hits), reverse=True)
+
+
+def test_lexical_mode_has_no_similarity(store):
+    hits = search_documents("pears", store.index, store.docs_info, lambda q: pytest.fail("embedded"), mode="lexical")
+    assert [hit["doc_id"] for hit in hits] == ["doc_chunk_2"]
+    assert hits[0]["similarity"] is None
+    assert 0 < hits[0]["score"] < 1